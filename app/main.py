@@ -1,4 +1,5 @@
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from app.routes import request_routes
 from app.routes import collection_routes
@@ -6,8 +7,16 @@ from app.routes import response_routes
 from app.routes import param_routes
 from .database import database, engine, Base, metadata
 from .models import collections, requests, params
+from .migrations import run_migrations
+from .utils.http_client import start_http_client, close_http_client
+from .utils.cache import row_cache
+from .utils.cache_events import invalidation_listener
+from .utils.blob_store import body_collector, legacy_body_mover
+from .utils.metrics import MetricsMiddleware, ServerTimingMiddleware, render_metrics
+from .utils.logging_config import RequestLogContextMiddleware
+from .settings import settings
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -15,18 +24,32 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"]
     )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(ServerTimingMiddleware, query_budget=settings.query_budget)
+app.add_middleware(RequestLogContextMiddleware, sample_rate=settings.log_sample_rate)
 1
 app.include_router(request_routes.router, prefix="/api")
 app.include_router(collection_routes.router, prefix="/api")
 app.include_router(response_routes.router, prefix="/api")
 app.include_router(param_routes.router, prefix="/api")
 
+@app.on_event("startup")
 async def startup():
-    async with engine.begin() as conn:
-        await conn.run_sync(metadata.create_all)
+    await run_migrations()
+    await invalidation_listener.start()
+    await body_collector.start()
+    await legacy_body_mover.start()
+
+@app.on_event("startup")
+async def open_http_client():
+    start_http_client()
 
 @app.on_event("shutdown")
 async def shutdown():
+    await close_http_client()
+    await invalidation_listener.stop()
+    await body_collector.stop()
+    await legacy_body_mover.stop()
     await engine.dispose()
 
 
@@ -37,3 +60,13 @@ def read_root():
 @app.get("/ping")
 def ping():
     return {"ping": "pong!"}
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return row_cache.stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,191 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+from sqlalchemy import text
+from app.database import engine, metadata
+from app.models import create_indexes_concurrently, response_bodies, response_body_chunks
+from app.utils.utils import logger
+
+# Any constant works; it only has to be the same in every worker process.
+MIGRATION_LOCK_ID = 7_260_343_118
+MIGRATION_LOCK_POLL_INTERVAL = 0.5
+DEFAULT_BACKFILL_BATCH_SIZE = 5000
+
+
+@dataclass
+class Migration:
+    version: int
+    description: str
+    apply: Callable[..., Awaitable[None]]
+    # Non-transactional migrations run on an autocommit connection (needed for
+    # CREATE INDEX CONCURRENTLY and batched backfills) and must be safe to
+    # re-run, since a crash can leave them half applied.
+    transactional: bool = True
+
+
+async def backfill_in_batches(statement, params: dict = None, batch_size: int = DEFAULT_BACKFILL_BATCH_SIZE, pause: float = 0.0):
+    # statement must touch at most :batch_size rows that still need the
+    # backfill, e.g. "UPDATE t SET ... WHERE id IN (SELECT id FROM t WHERE
+    # <not yet done> LIMIT :batch_size)". Each batch commits on its own so
+    # row locks are short-lived and writers are never blocked for long.
+    total = 0
+    while True:
+        async with engine.begin() as conn:
+            result = await conn.execute(text(statement), {**(params or {}), "batch_size": batch_size})
+        if result.rowcount <= 0:
+            return total
+        total += result.rowcount
+        if pause:
+            await asyncio.sleep(pause)
+
+
+async def _create_baseline_schema(conn):
+    await conn.run_sync(metadata.create_all)
+
+
+async def _add_response_timing_columns(conn):
+    await conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+    for column in ("connect_ms", "tls_ms", "ttfb_ms", "download_ms", "total_ms"):
+        await conn.execute(text(f"ALTER TABLE response ADD COLUMN IF NOT EXISTS {column} double precision"))
+
+
+CASCADE_FOREIGN_KEYS = [
+    ("requests", "collection_id", "collections"),
+    ("params", "request_id", "requests"),
+    ("response", "request_id", "requests"),
+]
+
+FIND_FOREIGN_KEY = text(
+    "SELECT c.conname, c.confdeltype, c.convalidated FROM pg_constraint c "
+    "JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey) "
+    "WHERE c.contype = 'f' AND c.conrelid = CAST(:table AS regclass) AND a.attname = :column"
+)
+
+
+async def _make_foreign_keys_cascade(conn):
+    # Re-added as NOT VALID so the swap doesn't scan the table under an
+    # exclusive lock; the next migration validates without blocking writes.
+    await conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+    for table, column, referenced in CASCADE_FOREIGN_KEYS:
+        constraint = (await conn.execute(FIND_FOREIGN_KEY, {"table": table, "column": column})).first()
+        if constraint is not None and constraint.confdeltype == "c":
+            continue
+        name = constraint.conname if constraint is not None else f"{table}_{column}_fkey"
+        if constraint is not None:
+            await conn.execute(text(f'ALTER TABLE "{table}" DROP CONSTRAINT "{name}"'))
+        await conn.execute(text(
+            f'ALTER TABLE "{table}" ADD CONSTRAINT "{name}" FOREIGN KEY ("{column}") '
+            f'REFERENCES "{referenced}" (id) ON DELETE CASCADE NOT VALID'
+        ))
+
+
+async def _validate_foreign_keys(conn):
+    for table, column, _ in CASCADE_FOREIGN_KEYS:
+        constraint = (await conn.execute(FIND_FOREIGN_KEY, {"table": table, "column": column})).first()
+        if constraint is not None and not constraint.convalidated:
+            await conn.execute(text(f'ALTER TABLE "{table}" VALIDATE CONSTRAINT "{constraint.conname}"'))
+
+
+async def _create_foreign_key_indexes(conn):
+    await create_indexes_concurrently(conn, {"ix_requests_collection_id", "ix_response_request_id_id"})
+
+
+async def _add_listing_versions(conn):
+    await conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+    # A constant default is stored in the catalog, so this doesn't rewrite the table.
+    await conn.execute(text("ALTER TABLE collections ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 0"))
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS listing_versions (name varchar PRIMARY KEY, version bigint NOT NULL DEFAULT 0)"
+    ))
+    await conn.execute(text("INSERT INTO listing_versions (name) VALUES ('collections') ON CONFLICT DO NOTHING"))
+
+
+async def _add_unique_param_keys(conn):
+    # Keep the newest row for each duplicated key, then build the unique index
+    # without blocking writes. A duplicate slipping in between the two steps
+    # makes the build fail; the migration is simply retried on next start.
+    await backfill_in_batches(
+        "DELETE FROM params WHERE id IN ("
+        "SELECT id FROM (SELECT id, row_number() OVER (PARTITION BY request_id, key ORDER BY id DESC) AS rn "
+        "FROM params) ranked WHERE rn > 1 LIMIT :batch_size)"
+    )
+    await create_indexes_concurrently(conn, {"uq_params_request_id_key"})
+
+
+async def _add_response_body_store(conn):
+    await conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+    await conn.run_sync(metadata.create_all, tables=[response_bodies, response_body_chunks])
+    for column, type_ in (("body_hash", "varchar(64)"), ("body_size", "bigint"), ("content_type", "varchar")):
+        await conn.execute(text(f"ALTER TABLE response ADD COLUMN IF NOT EXISTS {column} {type_}"))
+    if (await conn.execute(FIND_FOREIGN_KEY, {"table": "response", "column": "body_hash"})).first() is None:
+        await conn.execute(text(
+            "ALTER TABLE response ADD CONSTRAINT response_body_hash_fkey FOREIGN KEY (body_hash) "
+            "REFERENCES response_bodies (hash) NOT VALID"
+        ))
+
+
+async def _index_response_body_hash(conn):
+    # Existing JSONB bodies are moved by blob_store.move_legacy_bodies in the
+    # background after startup; reads fall back to them until then.
+    await create_indexes_concurrently(conn, {"ix_response_body_hash"})
+    constraint = (await conn.execute(FIND_FOREIGN_KEY, {"table": "response", "column": "body_hash"})).first()
+    if constraint is not None and not constraint.convalidated:
+        await conn.execute(text(f'ALTER TABLE response VALIDATE CONSTRAINT "{constraint.conname}"'))
+
+
+async def _drop_redundant_param_index(conn):
+    # uq_params_request_id_key covers every lookup by request_id.
+    await conn.execute(text('DROP INDEX CONCURRENTLY IF EXISTS "ix_params_request_id"'))
+
+
+MIGRATIONS = [
+    Migration(1, "baseline schema", _create_baseline_schema),
+    Migration(2, "response phase timing columns", _add_response_timing_columns),
+    Migration(3, "cascade deletes on foreign keys", _make_foreign_keys_cascade),
+    Migration(4, "validate cascading foreign keys", _validate_foreign_keys, transactional=False),
+    Migration(5, "foreign key and history indexes", _create_foreign_key_indexes, transactional=False),
+    Migration(6, "collection and listing versions for ETags", _add_listing_versions),
+    Migration(7, "unique parameter keys per request", _add_unique_param_keys, transactional=False),
+    Migration(8, "content-addressed response body store", _add_response_body_store),
+    Migration(9, "index and validate response body references", _index_response_body_hash, transactional=False),
+    Migration(10, "drop the single-column params index", _drop_redundant_param_index, transactional=False),
+]
+
+
+async def run_migrations():
+    async with engine.connect() as lock_conn:
+        lock_conn = await lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+        # Session-level lock: the first worker to start migrates, the others
+        # wait here and then find nothing left to do. Waiters poll instead of
+        # blocking in pg_advisory_lock, because CREATE INDEX CONCURRENTLY waits
+        # for every open statement and would deadlock with a blocked waiter.
+        while not (await lock_conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})).scalar():
+            await asyncio.sleep(MIGRATION_LOCK_POLL_INTERVAL)
+        try:
+            await lock_conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS schema_version ("
+                "version integer PRIMARY KEY, description text NOT NULL, "
+                "applied_at timestamptz NOT NULL DEFAULT now())"
+            ))
+            applied = set((await lock_conn.execute(text("SELECT version FROM schema_version"))).scalars().all())
+
+            for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+                if migration.version in applied:
+                    continue
+
+                logger.info("Applying migration %s: %s", migration.version, migration.description)
+                record = text("INSERT INTO schema_version (version, description) VALUES (:version, :description)")
+                values = {"version": migration.version, "description": migration.description}
+                if migration.transactional:
+                    async with engine.begin() as conn:
+                        await migration.apply(conn)
+                        await conn.execute(record, values)
+                else:
+                    await migration.apply(lock_conn)
+                    await lock_conn.execute(record, values)
+        finally:
+            await lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+
+
+if __name__ == "__main__":
+    asyncio.run(run_migrations())
@@ -1,4 +1,4 @@
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, Enum
+from sqlalchemy import Table, Column, Integer, BigInteger, String, Float, ForeignKey, Enum, Index, LargeBinary, DateTime, text
 from .database import metadata
 import enum
 from sqlalchemy.dialects.postgresql import JSONB
@@ -13,6 +13,18 @@ collections = Table(
     metadata,
     Column("id", Integer, primary_key=True),
     Column("name", String),
+    # Bumped whenever the collection or its list of requests changes; used as
+    # the ETag of GET /collections/{id}/requests.
+    Column("version", Integer, nullable=False, server_default="0"),
+)
+
+# One row per list endpoint whose contents aren't covered by a single
+# collection's version (currently just "collections").
+listing_versions = Table(
+    "listing_versions",
+    metadata,
+    Column("name", String, primary_key=True),
+    Column("version", BigInteger, nullable=False, server_default="0"),
 )
 
 requests = Table(
@@ -23,7 +35,7 @@ requests = Table(
     Column("method", String),
     Column("body", JSONB),
     Column("bodytype", Enum(BodyType)),
-    Column("collection_id", Integer, ForeignKey("collections.id")),
+    Column("collection_id", Integer, ForeignKey("collections.id", ondelete="CASCADE"), index=True),
 )
 
 params = Table(
@@ -32,14 +44,76 @@ params = Table(
     Column("id", Integer, primary_key=True),
     Column("key", String),
     Column("value", String),
-    Column("request_id", Integer, ForeignKey("requests.id")),
+    Column("request_id", Integer, ForeignKey("requests.id", ondelete="CASCADE")),
+    # Conflict target for the bulk upsert in PUT /requests/{id}/params. Leads
+    # with request_id, so it also serves lookups and cascades by request.
+    Index("uq_params_request_id_key", "request_id", "key", unique=True),
+)
+
+# Response bodies are stored once per distinct content, keyed by the SHA-256
+# of the uncompressed bytes, and split into fixed-size chunks that are
+# zstd-compressed independently so a byte range can be read without
+# decompressing the whole body.
+response_bodies = Table(
+    "response_bodies",
+    metadata,
+    Column("hash", String(64), primary_key=True),
+    Column("size", BigInteger, nullable=False),
+    Column("chunk_size", Integer, nullable=False),
+    # Refreshed whenever a new response reuses the body; orphaned bodies are
+    # only collected once this is old enough.
+    Column("last_used_at", DateTime(timezone=True), nullable=False, server_default=text("now()")),
+)
+
+response_body_chunks = Table(
+    "response_body_chunks",
+    metadata,
+    Column("hash", String(64), ForeignKey("response_bodies.hash", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True),
+    Column("seq", Integer, primary_key=True),
+    Column("data", LargeBinary, nullable=False),
 )
 
 response = Table(
     "response",
     metadata,
     Column("id", Integer, primary_key=True),
+    # Only set on rows written before bodies moved to response_bodies.
     Column("body", JSONB),
+    Column("body_hash", String(64), ForeignKey("response_bodies.hash"), index=True),
+    Column("body_size", BigInteger),
+    Column("content_type", String),
     Column("status_code", Integer),
-    Column("request_id", Integer, ForeignKey("requests.id"))
-)
\ No newline at end of file
+    Column("connect_ms", Float),
+    Column("tls_ms", Float),
+    Column("ttfb_ms", Float),
+    Column("download_ms", Float),
+    Column("total_ms", Float),
+    Column("request_id", Integer, ForeignKey("requests.id", ondelete="CASCADE")),
+    # Leading request_id also serves plain lookups and the cascade from requests.
+    Index("ix_response_request_id_id", "request_id", "id"),
+)
+
+
+async def create_indexes_concurrently(conn, names):
+    # conn must be in AUTOCOMMIT mode: CREATE INDEX CONCURRENTLY can't run in a
+    # transaction, but it doesn't block writes on tables that already have data.
+    # Each migration names the indexes it builds: the metadata describes the
+    # latest schema, whose columns may not exist yet at that migration.
+    for table in metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name not in names:
+                continue
+            # An interrupted concurrent build leaves an invalid index behind
+            # that IF NOT EXISTS would otherwise skip over.
+            invalid = await conn.execute(text(
+                "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :name AND NOT i.indisvalid"
+            ), {"name": index.name})
+            if invalid.first():
+                await conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+
+            columns = ", ".join(f'"{c.name}"' for c in index.columns)
+            unique = "UNIQUE " if index.unique else ""
+            await conn.execute(text(
+                f'CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS "{index.name}" ON "{table.name}" ({columns})'
+            ))
\ No newline at end of file
@@ -1,10 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException
+import time
+from typing import Optional
+import ijson
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
-from app.database import get_db
-from app.models import collections, requests, params, response
-from sqlalchemy import update, delete, select
-from app.utils.utils import check_collection_exists, check_requests_exist, handle_server_error, logger
+from app.database import get_db, get_read_db
+from app.models import collections, requests, params
+from sqlalchemy import update, delete, select, literal, Integer
+from app.utils.utils import check_collection_exists, check_requests_exist, invalidate_cached_row, invalidate_collection_requests, handle_server_error, bump_listing_version, get_listing_version, make_etag, etag_matches, not_modified, json_page_query, raw_json_response, logger, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from app.utils.postman import PostmanRequestParser, convert_request, insert_imported_requests, stream_collection_export, is_v21_schema, IMPORT_BATCH_SIZE
+from app.utils.executor import run_requests, group_params, DEFAULT_RUN_CONCURRENCY, MAX_RUN_CONCURRENCY
 from app.schemas.collection_schemas import RequestPayload, UpdatePayload
 
 router = APIRouter()
@@ -15,104 +21,244 @@ async def add_collection(payload: RequestPayload, db: Session = Depends(get_db))
     try:
         query = collections.insert().values(name=payload.name)
         result = await db.execute(query)
-        await db.commit()
+        await bump_listing_version(db, "collections")
 
         inserted_id = result.inserted_primary_key[0]
-        logger.info(f"Collection added with ID: {inserted_id}")
+        logger.info("Collection added with ID: %s", inserted_id)
 
         return {"message": "Collection added successfully", "collection_id": inserted_id}
     except Exception as e:
         handle_server_error(e)
 
 
-def serialize_collection(collection):
-    return {
-        "id": collection.id,
-        "name": collection.name,
-    }
+@router.post("/collections/import")
+async def import_collection(
+    request: Request,
+    name: Optional[str] = Query(None, description="Collection name; defaults to info.name from the export"),
+    db: Session = Depends(get_db),
+):
+    try:
+        # The body is parsed as it arrives, so memory use depends on the batch
+        # size rather than the size of the export. Everything is inserted in
+        # the session's one transaction: a failed import leaves nothing behind.
+        result = await db.execute(collections.insert().values(name=name or "Imported collection").returning(collections.c.id))
+        collection_id = result.scalar()
+
+        parser = PostmanRequestParser()
+        events = ijson.sendable_list()
+        coro = ijson.parse_coro(events)
+        batch, imported, skipped, param_count = [], 0, 0, 0
+
+        async def flush():
+            nonlocal batch, imported, param_count
+            if batch:
+                param_count += await insert_imported_requests(db, collection_id, batch)
+                imported += len(batch)
+                batch = []
+
+        async def consume():
+            nonlocal skipped
+            for prefix, event, value in events:
+                parser.feed(prefix, event, value)
+            events.clear()
+            if parser.schema is not None and not is_v21_schema(parser.schema):
+                raise HTTPException(status_code=400, detail=f"Unsupported collection schema: {parser.schema}; expected Postman v2.1")
+            for item in parser.drain():
+                converted = convert_request(item) if isinstance(item, dict) else None
+                if converted is None:
+                    skipped += 1
+                    continue
+                batch.append(converted)
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    await flush()
+
+        try:
+            async for chunk in request.stream():
+                if chunk:
+                    coro.send(chunk)
+                    await consume()
+            coro.close()
+        except ijson.JSONError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid collection JSON: {e}")
+        await consume()
+        if parser.schema is None:
+            raise HTTPException(status_code=400, detail="Collection has no info.schema; expected a Postman v2.1 export")
+        await flush()
+
+        if name is None and parser.collection_name:
+            await db.execute(update(collections).where(collections.c.id == collection_id).values(name=parser.collection_name))
+        await bump_listing_version(db, "collections")
+
+        logger.info("Imported collection %s: %s requests, %s params, %s skipped", collection_id, imported, param_count, skipped)
+        return {
+            "message": "Collection imported successfully",
+            "collection_id": collection_id,
+            "requests": imported,
+            "params": param_count,
+            "skipped": skipped,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        handle_server_error(e)
+
 
 @router.get("/collections")
-async def get_all_collections(db: Session = Depends(get_db)):
+async def get_all_collections(
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of collections to return"),
+    after: Optional[int] = Query(None, description="Return collections with an ID greater than this cursor"),
+    db: Session = Depends(get_read_db),
+):
     try:
-        collections_list = await db.execute(select(collections))
-        collections_data = [serialize_collection(c) for c in collections_list.scalars().all()]
+        etag = make_etag("collections", await get_listing_version(db, "collections"))
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return not_modified(etag)
+
+        page = (await db.execute(json_page_query(select(collections.c.id, collections.c.name), collections.c.id, limit, after, "collections"))).one()
 
-        if not collections_data:
+        if not page.count and after is None:
             raise HTTPException(status_code=404, detail="No collections found")
 
         logger.info("Retrieved all collections")
-        return collections_data
+        return raw_json_response(page.body, etag)
     except Exception as e:
         handle_server_error(e)
 
 
-def serialize_requests(requests):
-    return {
-        "id": requests.id,
-        "url": requests.url,
-        "method": requests.method,
-        "body": requests.body,
-        "bodytype": requests.bodytype,
-        "collection_id": requests.collection_id
-    }
-
 @router.get("/collections/{collection_id}/requests")
-async def get_requests_by_collection_id(collection_id: int, db: Session = Depends(get_db)):
+async def get_requests_by_collection_id(
+    collection_id: int,
+    request: Request,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of requests to return"),
+    after: Optional[int] = Query(None, description="Return requests with an ID greater than this cursor"),
+    db: Session = Depends(get_read_db),
+):
     try:
-        requests_list = await check_requests_exist(db, collection_id)
-        request_data = [serialize_requests(c) for c in requests_list]
+        collection = await check_collection_exists(db, collection_id)
+        etag = make_etag("collection", collection_id, collection.version)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return not_modified(etag)
 
-        logger.info(f"Retrieved requests for collection ID {collection_id}")
-        return request_data
+        query = select(requests).where(requests.c.collection_id == collection_id)
+        envelope = {"collection_id": literal(collection_id, Integer)}
+        page = (await db.execute(json_page_query(query, requests.c.id, limit, after, "requests", envelope))).one()
+
+        if not page.count and after is None:
+            raise HTTPException(status_code=404, detail="No requests found for this collection ID")
+
+        logger.info("Retrieved requests for collection ID %s", collection_id)
+        return raw_json_response(page.body, etag)
     except Exception as e:
         handle_server_error(e)
 
 
 @router.get("/collections/{collection_id}")
-async def get_collection_by_id(collection_id: int, db: Session = Depends(get_db)):
+async def get_collection_by_id(collection_id: int, db: Session = Depends(get_read_db)):
     try:
         collection = await check_collection_exists(db, collection_id)
-        logger.info(f"Retrieved collection with ID {collection_id}")
+        logger.info("Retrieved collection with ID %s", collection_id)
         return {"collection_id": collection.id, "name": collection.name, "status_code": 200}
     except Exception as e:
         handle_server_error(e)
 
+@router.get("/collections/{collection_id}/export")
+async def export_collection(
+    collection_id: int,
+    export_format: str = Query("postman", alias="format", pattern="^(postman|ndjson)$", description="postman (v2.1 JSON) or ndjson"),
+    include_responses: bool = Query(False, description="Include the latest saved response of each request"),
+    db: Session = Depends(get_read_db),
+):
+    try:
+        collection = await check_collection_exists(db, collection_id)
+        await db.close()
+
+        if export_format == "ndjson":
+            media_type, filename = "application/x-ndjson", f"collection-{collection_id}.ndjson"
+        else:
+            media_type, filename = "application/json", f"collection-{collection_id}.postman_collection.json"
+
+        logger.info("Exporting collection ID %s as %s", collection_id, export_format)
+        return StreamingResponse(
+            stream_collection_export(collection, export_format, include_responses),
+            media_type=media_type,
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        handle_server_error(e)
+
+@router.post("/collections/{collection_id}/run")
+async def run_collection(
+    collection_id: int,
+    concurrency: int = Query(DEFAULT_RUN_CONCURRENCY, ge=1, le=MAX_RUN_CONCURRENCY, description="Maximum number of requests in flight"),
+    db: Session = Depends(get_read_db),
+):
+    try:
+        request_rows = await check_requests_exist(db, collection_id)
+        param_rows = await db.execute(
+            select(params).join(requests, params.c.request_id == requests.c.id).where(requests.c.collection_id == collection_id)
+        )
+        params_by_request = group_params(param_rows.fetchall())
+
+        # The run can take minutes; don't hold a pooled connection for it.
+        await db.close()
+
+        start = time.perf_counter()
+        summary = await run_requests(request_rows, params_by_request, concurrency)
+        elapsed_ms = round((time.perf_counter() - start) * 1000, 3)
+
+        logger.info("Ran collection ID %s: %s succeeded, %s failed", collection_id, summary.succeeded, summary.failed)
+        return {
+            "collection_id": collection_id,
+            "total": summary.total,
+            "succeeded": summary.succeeded,
+            "failed": summary.failed,
+            "saved": summary.saved,
+            "elapsed_ms": elapsed_ms,
+            "errors": summary.errors,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        handle_server_error(e)
+
+
 @router.delete("/delete_collection/{collection_id}")
 async def delete_collection(collection_id: int, db: Session = Depends(get_db)):
     try:
-        await check_collection_exists(db, collection_id)
-
-        request_ids = await db.execute(select(requests.c.id).where(requests.c.collection_id == collection_id))
-        request_ids = request_ids.scalars().all()
+        # requests, params and response rows go with it via ON DELETE CASCADE.
+        result = await db.execute(delete(collections).where(collections.c.id == collection_id))
 
-        if request_ids:
-            await db.execute(delete(response).where(response.c.request_id.in_(request_ids)))
-            await db.execute(delete(params).where(params.c.request_id.in_(request_ids)))
-            await db.execute(delete(requests).where(requests.c.collection_id == collection_id))
+        if result.rowcount == 0:
+            raise HTTPException(status_code=404, detail="Collection not found")
 
-        await db.execute(delete(collections).where(collections.c.id == collection_id))
-        await db.commit()
+        invalidate_cached_row(db, collections, collection_id)
+        invalidate_collection_requests(db, collection_id)
+        await bump_listing_version(db, "collections")
 
-        logger.info(f"Collection and associated data deleted successfully for collection ID {collection_id}")
+        logger.info("Collection and associated data deleted successfully for collection ID %s", collection_id)
         return {"message": "Collection and all associated data deleted successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
-        await db.rollback()
         handle_server_error(e)
         
 
 @router.patch("/update_collection/{collection_id}")
 async def update_collection(collection_id: int, payload: UpdatePayload, db: Session = Depends(get_db)):
     try:
-        stmt = update(collections).where(collections.c.id == collection_id).values(name=payload.new_name)
+        stmt = update(collections).where(collections.c.id == collection_id).values(name=payload.new_name, version=collections.c.version + 1)
 
         result = await db.execute(stmt)
 
         if result.rowcount == 0:
             raise HTTPException(status_code=404, detail="Collection not found")
 
-        await db.commit()
-        logger.info(f"Collection ID {collection_id} updated successfully")
+        invalidate_cached_row(db, collections, collection_id)
+        await bump_listing_version(db, "collections")
+        logger.info("Collection ID %s updated successfully", collection_id)
         return {"message": "Collection updated successfully"}
     except Exception as e:
-        await db.rollback()
         handle_server_error(e)
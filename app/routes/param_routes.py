@@ -1,11 +1,13 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
-from app.database import get_db
+from app.database import get_db, get_read_db
 from app.models import params
-from sqlalchemy import update, delete, select
-from app.utils.utils import check_request_exists, check_param_exists, handle_server_error, logger
-from app.schemas.params_schema import AddParamPayload, UpdateParamPayload
+from sqlalchemy import update, delete, select, literal, Integer
+from sqlalchemy.exc import IntegrityError
+from app.utils.utils import check_request_exists, replace_params, upsert_params, handle_server_error, json_page_query, raw_json_response, logger, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from app.schemas.params_schema import AddParamPayload, UpdateParamPayload, ReplaceParamsPayload
 
 router = APIRouter()
 
@@ -14,25 +16,32 @@ async def add_param(payload: AddParamPayload, db: AsyncSession = Depends(get_db)
     try:
         await check_request_exists(db, payload.request_id)
 
-        new_param = params.insert().values(
-            key=payload.key,
-            value=payload.value,
-            request_id=payload.request_id
-        )
-        await db.execute(new_param)
-        await db.commit()
+        await db.execute(upsert_params(payload.request_id, {payload.key: payload.value}))
 
-        logger.info(f"Parameter added successfully to request {payload.request_id}")
+        logger.info("Parameter added successfully to request %s", payload.request_id)
         return {"message": "Parameter added successfully"}
     except Exception as e:
-        await db.rollback()
+        handle_server_error(e)
+
+@router.put("/requests/{request_id}/params")
+async def replace_request_params(request_id: int, payload: ReplaceParamsPayload, db: AsyncSession = Depends(get_db)):
+    try:
+        await check_request_exists(db, request_id)
+
+        # Later duplicates of a key win, as they would in a query string dict.
+        values = {item.key: item.value for item in payload.params}
+        await replace_params(db, request_id, values)
+
+        logger.info("Replaced parameters of request %s with %s keys", request_id, len(values))
+        return {"message": "Parameters replaced successfully", "count": len(values)}
+    except HTTPException:
+        raise
+    except Exception as e:
         handle_server_error(e)
 
 @router.put("/update_param/{param_id}")
 async def update_param(param_id: int, payload: UpdateParamPayload, db: AsyncSession = Depends(get_db)):
     try:
-        await check_param_exists(db, param_id)
-
         update_values = {}
         if payload.key is not None:
             update_values['key'] = payload.key
@@ -42,48 +51,54 @@ async def update_param(param_id: int, payload: UpdateParamPayload, db: AsyncSess
         if not update_values:
             raise HTTPException(status_code=400, detail="No values provided for update")
 
-        query = update(params).where(params.c.id == param_id).values(update_values)
-        await db.execute(query)
-        await db.commit()
+        query = update(params).where(params.c.id == param_id).values(update_values).returning(params.c.id)
+        try:
+            updated = (await db.execute(query)).scalar()
+        except IntegrityError:
+            raise HTTPException(status_code=409, detail=f"Request already has a parameter named {payload.key!r}")
+        if updated is None:
+            raise HTTPException(status_code=404, detail="Parameter not found")
 
-        logger.info(f"Parameter with ID {param_id} updated successfully")
+        logger.info("Parameter with ID %s updated successfully", param_id)
         return {"message": "Parameter updated successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
-        await db.rollback()
         handle_server_error(e)
 
 @router.delete("/delete_param/{param_id}")
 async def delete_param(param_id: int, db: AsyncSession = Depends(get_db)):
     try:
-        await check_param_exists(db, param_id)
-
-        query = delete(params).where(params.c.id == param_id)
-        await db.execute(query)
-        await db.commit()
+        query = delete(params).where(params.c.id == param_id).returning(params.c.id)
+        if (await db.execute(query)).scalar() is None:
+            raise HTTPException(status_code=404, detail="Parameter not found")
 
-        logger.info(f"Parameter with ID {param_id} deleted successfully")
+        logger.info("Parameter with ID %s deleted successfully", param_id)
         return {"message": "Parameter deleted successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
-        await db.rollback()
         handle_server_error(e)
 
 
 @router.get("/get_params/{request_id}")
-async def get_params(request_id: int, db: AsyncSession = Depends(get_db)):
+async def get_params(
+    request_id: int,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of parameters to return"),
+    after: Optional[int] = Query(None, description="Return parameters with an ID greater than this cursor"),
+    db: AsyncSession = Depends(get_read_db),
+):
     try:
         await check_request_exists(db, request_id)
 
-        query = select(params).where(params.c.request_id == request_id)
-        result = await db.execute(query)
-        rows = result.fetchall()
+        query = select(params.c.id, params.c.key, params.c.value).where(params.c.request_id == request_id)
+        envelope = {"request_id": literal(request_id, Integer)}
+        page = (await db.execute(json_page_query(query, params.c.id, limit, after, "params", envelope))).one()
 
-        if not rows:
+        if not page.count and after is None:
             raise HTTPException(status_code=404, detail="No parameters found for the given request_id")
 
-        params_list = [{"id": row.id, "key": row.key, "value": row.value} for row in rows]
-
-        logger.info(f"Retrieved parameters for request {request_id}")
-        return {"request_id": request_id, "params": params_list}
+        logger.info("Retrieved parameters for request %s", request_id)
+        return raw_json_response(page.body)
     except Exception as e:
         handle_server_error(e)
-
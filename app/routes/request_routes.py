@@ -1,45 +1,51 @@
+import httpx
 from fastapi import APIRouter, Depends, HTTPException, Path
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import insert, delete
-from app.database import get_db
-from app.models import collections, requests, params, response, BodyType
-from app.utils.utils import get_or_404, handle_server_error, validate_http_method, validate_request_body, logger
-from app.schemas.request_schema import RequestBody
+from sqlalchemy import insert, delete, select
+from app.database import get_db, get_read_db
+from app.models import requests, params, response, BodyType
+from app.utils.utils import check_request_exists, invalidate_cached_row, bump_collection_version, handle_server_error, validate_http_method, validate_request_body, logger
+from app.utils.executor import execute_request
+from app.utils.blob_store import save_bodies, body_encoding
+from app.utils.load_test import run_load_test
+from app.schemas.request_schema import RequestBody, LoadTestPayload
 
 router = APIRouter()
 
 @router.delete("/requests/{request_id}")
 async def delete_request(request_id: int = Path(..., description="ID of the request to delete"), db: AsyncSession = Depends(get_db)):
     try:
-        logger.info(f"Deleting request with ID {request_id}")
+        logger.info("Deleting request with ID %s", request_id)
 
-        await db.execute(delete(response).where(response.c.request_id == request_id))
-        await db.execute(delete(params).where(params.c.request_id == request_id))
+        # params and response rows go with it via ON DELETE CASCADE.
+        delete_result = await db.execute(delete(requests).where(requests.c.id == request_id).returning(requests.c.collection_id))
+        deleted = delete_result.first()
 
-        delete_result = await db.execute(delete(requests).where(requests.c.id == request_id))
-
-        if delete_result.rowcount == 0:
+        if deleted is None:
             raise HTTPException(status_code=404, detail="Request not found")
 
-        await db.commit()
+        invalidate_cached_row(db, requests, request_id)
+        if deleted.collection_id is not None:
+            await bump_collection_version(db, deleted.collection_id)
+
         return {"detail": "Request and associated data deleted successfully"}
     except HTTPException:
         raise
     except Exception as e:
-        await db.rollback()
         handle_server_error(e)
 
 
 @router.post("/save_request")
 async def save_request(data: RequestBody, db: AsyncSession = Depends(get_db)):
     try:
-        if data.collection_id is not None:
-            await get_or_404(db, collections, data.collection_id, "Collection not found")
-
         validate_http_method(data.method)
 
         validate_request_body(data.method, data.body)
 
+        if data.collection_id is not None:
+            # Doubles as the existence check for the collection.
+            await bump_collection_version(db, data.collection_id)
+
         query = insert(requests).values(
             url=data.url,
             method=data.method,
@@ -51,7 +57,10 @@ async def save_request(data: RequestBody, db: AsyncSession = Depends(get_db)):
         result = await db.execute(query)
         request_id = result.scalar()  # Updated this to extract the scalar value directly
 
-        await db.commit()
+        if data.params:
+            await db.execute(insert(params).values([
+                {"request_id": request_id, "key": key, "value": value} for key, value in data.params.items()
+            ]))
 
         response_data = {
             "status": "success",
@@ -65,8 +74,77 @@ async def save_request(data: RequestBody, db: AsyncSession = Depends(get_db)):
         if data.method in ["POST", "PATCH", "PUT"]:
             response_data["body"] = data.body
 
-        logger.info(f"Inserted request with ID: {request_id}")
+        if data.params:
+            response_data["params"] = data.params
+
+        logger.info("Inserted request with ID: %s", request_id)
         return response_data
+    except HTTPException:
+        raise
+    except Exception as e:
+        handle_server_error(e)
+
+
+@router.post("/requests/{request_id}/send")
+async def send_request(request_id: int = Path(..., description="ID of the saved request to send"), db: AsyncSession = Depends(get_db)):
+    try:
+        request_row = await check_request_exists(db, request_id)
+        param_rows = (await db.execute(select(params).where(params.c.request_id == request_id))).fetchall()
+
+        # Give the pooled DB connection back while we wait on the remote server.
+        await db.close()
+
+        try:
+            result = await execute_request(request_row, param_rows, keep_body=True)
+        except (httpx.HTTPError, httpx.InvalidURL) as e:
+            raise HTTPException(status_code=502, detail=f"Request failed: {str(e)}")
+
+        await save_bodies(db, [result.body_writer])
+        query = response.insert().values(result.as_row(request_id)).returning(response.c.id)
+        response_id = (await db.execute(query)).scalar()
+
+        logger.info("Sent request %s, saved response with ID: %s", request_id, response_id)
+        return {
+            "response_id": response_id,
+            "request_id": request_id,
+            "status_code": result.status_code,
+            "elapsed_ms": result.elapsed_ms,
+            "timings": result.timings,
+            "content_type": result.content_type,
+            "body_size": result.body_writer.size,
+            "body_encoding": body_encoding(result.content_type),
+            # None when the body is too large to return inline; it is still
+            # stored in full.
+            "body": result.body,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        handle_server_error(e)
+
+
+@router.post("/requests/{request_id}/load_test")
+async def load_test_request(payload: LoadTestPayload, request_id: int = Path(..., description="ID of the saved request to load test"), db: AsyncSession = Depends(get_read_db)):
+    try:
+        if (payload.total_requests is None) == (payload.duration_seconds is None):
+            raise HTTPException(status_code=400, detail="Provide exactly one of total_requests or duration_seconds")
+
+        request_row = await check_request_exists(db, request_id)
+        param_rows = (await db.execute(select(params).where(params.c.request_id == request_id))).fetchall()
+        await db.close()
+
+        result = await run_load_test(
+            request_row,
+            param_rows,
+            concurrency=payload.concurrency,
+            total_requests=payload.total_requests,
+            duration_seconds=payload.duration_seconds,
+            rate=payload.rate,
+        )
+
+        logger.info("Load test of request %s finished: %s sends, %s errors", request_id, result['requests'], result['errors'])
+        return {"request_id": request_id, **result}
+    except HTTPException:
+        raise
     except Exception as e:
-        await db.rollback()
         handle_server_error(e)
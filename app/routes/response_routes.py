@@ -1,79 +1,213 @@
-from fastapi import APIRouter, HTTPException, Depends
+from typing import Optional
+import ijson
+import orjson
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import update, select
-from app.database import get_db
+from sqlalchemy import update, select, exists, literal, null, cast, Integer, BigInteger, String, Text
+from sqlalchemy.dialects.postgresql import ARRAY
+from app.database import get_db, get_read_db
 from app.models import response, requests
-from app.utils.utils import get_or_404, handle_server_error
+from app.utils.utils import get_or_404, check_request_exists, handle_server_error, make_etag, etag_matches, not_modified, parse_byte_range, parse_json_pointer, raw_json_response, logger
+from app.models import response_bodies
+from app.utils.blob_store import BodyWriter, encode_body, serialize_body, store_bodies, save_bodies, response_body_value, body_encoding, is_json_content_type, stream_body, extract_json_pointer
 from app.schemas.response_schema import SaveResponseRequest, UpdateResponseRequest
 
 router = APIRouter()
 
+async def insert_response(db: AsyncSession, request_id: int, status_code: int, body_hash: str, body_size: int, content_type: str):
+    # INSERT ... SELECT ... WHERE EXISTS: the existence check and the insert
+    # are one statement, and no row comes back if the request is missing.
+    source = select(
+        literal(request_id, Integer),
+        literal(body_hash, String),
+        literal(body_size, BigInteger),
+        literal(content_type, String),
+        literal(status_code, Integer),
+    ).where(exists().where(requests.c.id == request_id))
+    new_response = response.insert().from_select(
+        ["request_id", "body_hash", "body_size", "content_type", "status_code"], source
+    ).returning(response.c.id)
+    response_id = (await db.execute(new_response)).scalar()
+
+    if response_id is None:
+        raise HTTPException(status_code=404, detail="Request not found")
+    return response_id
+
 @router.post("/responses")
 async def save_response(data: SaveResponseRequest, db: AsyncSession = Depends(get_db)):
     try:
-        await get_or_404(db, requests, data.request_id, "Request not found")
+        content, content_type = serialize_body(data.body, data.content_type)
+        stored_body = encode_body(content)
+        await store_bodies(db, [stored_body])
 
-        new_response = response.insert().values(
-            request_id=data.request_id,
-            body=data.body,  
-            status_code=data.status_code
-        )
-        await db.execute(new_response)
-        await db.commit()
-        
-        return {"message": "Response saved successfully"}
+        response_id = await insert_response(db, data.request_id, data.status_code, stored_body.hash, stored_body.size, content_type)
+        return {"message": "Response saved successfully", "response_id": response_id}
+    except HTTPException:
+        raise
+    except Exception as e:
+        handle_server_error(e)
+
+@router.post("/responses/upload")
+async def upload_response(
+    request: Request,
+    request_id: int = Query(..., description="ID of the request the response belongs to"),
+    status_code: int = Query(None, description="HTTP status code of the response"),
+    db: AsyncSession = Depends(get_db),
+):
+    try:
+        # The raw request body is the response body, stored byte for byte
+        # with the request's Content-Type; it is never held whole in memory.
+        await check_request_exists(db, request_id)
+        # Don't hold a pooled connection while the upload is being received.
+        await db.close()
+
+        writer = BodyWriter()
+        try:
+            async for chunk in request.stream():
+                await writer.write(chunk)
+            await writer.close()
+        except BaseException:
+            await writer.discard()
+            raise
+        await save_bodies(db, [writer])
+
+        content_type = request.headers.get("content-type")
+        response_id = await insert_response(db, request_id, status_code, writer.hash, writer.size, content_type)
+
+        logger.info("Uploaded %s byte response body for request %s", writer.size, request_id)
+        return {"message": "Response saved successfully", "response_id": response_id, "body_size": writer.size}
+    except HTTPException:
+        raise
     except Exception as e:
-        await db.rollback()
         handle_server_error(e)
 
 @router.get("/responses/{response_id}")
-async def get_response(response_id: int, db: AsyncSession = Depends(get_db)):
+async def get_response(response_id: int, db: AsyncSession = Depends(get_read_db)):
     try:
         result = await get_or_404(db, response, response_id, "Response not found")
 
         response_data = {
             "response_id": result.id,
             "request_id": result.request_id,
-            "body": result.body,
-            "status_code": result.status_code
+            "body": await response_body_value(db, result),
+            "content_type": result.content_type,
+            "body_size": result.body_size,
+            "body_encoding": body_encoding(result.content_type) if result.body_hash is not None else None,
+            "status_code": result.status_code,
+            "timings": {
+                "connect_ms": result.connect_ms,
+                "tls_ms": result.tls_ms,
+                "ttfb_ms": result.ttfb_ms,
+                "download_ms": result.download_ms,
+                "total_ms": result.total_ms,
+            }
         }
         return response_data
     except Exception as e:
         handle_server_error(e)
 
+@router.get("/responses/{response_id}/body")
+async def get_response_body(
+    response_id: int,
+    request: Request,
+    pointer: Optional[str] = Query(None, description="JSON Pointer (RFC 6901) selecting part of a JSON body, e.g. /items/0"),
+    db: AsyncSession = Depends(get_read_db),
+):
+    try:
+        result = await get_or_404(db, response, response_id, "Response not found")
+        tokens = parse_json_pointer(pointer) if pointer is not None else None
+
+        if result.body_hash is None:
+            # Rows from before the body store: the JSONB column is navigated
+            # and rendered by Postgres.
+            column = response.c.body if tokens is None else response.c.body.op("#>")(cast(tokens, ARRAY(Text)))
+            body = (await db.execute(select(cast(column, Text)).where(response.c.id == response_id))).scalar()
+            if body is None:
+                raise HTTPException(status_code=404, detail="Pointer not found" if tokens is not None else "Response has no body")
+            if tokens is not None:
+                return raw_json_response(body)
+            content, content_type, etag = body.encode(), "application/json", None
+        else:
+            content, content_type, etag = None, result.content_type or "application/octet-stream", make_etag(result.body_hash)
+
+        if tokens is not None:
+            if not is_json_content_type(result.content_type):
+                raise HTTPException(status_code=400, detail="JSON Pointer requires a JSON body")
+            await db.close()
+            try:
+                value = await extract_json_pointer(result.body_hash, tokens)
+            except KeyError:
+                raise HTTPException(status_code=404, detail="Pointer not found")
+            except ijson.JSONError:
+                raise HTTPException(status_code=422, detail="Stored body is not valid JSON")
+            return Response(content=orjson.dumps(value), media_type="application/json")
+
+        if etag is not None and etag_matches(request.headers.get("if-none-match"), etag):
+            return not_modified(etag)
+
+        size = len(content) if content is not None else result.body_size
+        headers = {"Accept-Ranges": "bytes"}
+        if etag is not None:
+            headers["ETag"] = etag
+        byte_range = parse_byte_range(request.headers.get("range"), size)
+        if byte_range is None:
+            start, end, status_code = 0, size - 1, 200
+        else:
+            (start, end), status_code = byte_range, 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+
+        if content is not None or size == 0:
+            return Response(content=(content or b"")[start:end + 1], status_code=status_code, media_type=content_type, headers=headers)
+
+        chunk_size = (await db.execute(select(response_bodies.c.chunk_size).where(response_bodies.c.hash == result.body_hash))).scalar()
+        await db.close()
+        return StreamingResponse(
+            stream_body(result.body_hash, chunk_size, start, end),
+            status_code=status_code,
+            media_type=content_type,
+            headers=headers,
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        handle_server_error(e)
+
 @router.put("/responses/{response_id}")
 async def update_response(response_id: int, data: UpdateResponseRequest, db: AsyncSession = Depends(get_db)):
     try:
         update_values = {}
         if data.body is not None:
-            update_values['body'] = data.body
+            content, content_type = serialize_body(data.body, data.content_type)
+            stored_body = encode_body(content)
+            await store_bodies(db, [stored_body])
+            update_values.update(body=null(), body_hash=stored_body.hash, body_size=stored_body.size, content_type=content_type)
         if data.status_code is not None:
             update_values['status_code'] = data.status_code
 
         if not update_values:
             raise HTTPException(status_code=400, detail="No values provided for update")
 
-        await get_or_404(db, response, response_id, "Response not found")
-
-        query = update(response).where(response.c.id == response_id).values(update_values)
-        await db.execute(query)
-        await db.commit()
+        query = update(response).where(response.c.id == response_id).values(update_values).returning(response.c.id)
+        if (await db.execute(query)).scalar() is None:
+            raise HTTPException(status_code=404, detail="Response not found")
 
         return {"message": "Response updated successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
-        await db.rollback()
         handle_server_error(e)
 
 @router.delete("/responses/{response_id}")
 async def delete_response(response_id: int, db: AsyncSession = Depends(get_db)):
     try:
-        await get_or_404(db, response, response_id, "Response not found")
-
-        query = response.delete().where(response.c.id == response_id)
-        await db.execute(query)
-        await db.commit()
+        query = response.delete().where(response.c.id == response_id).returning(response.c.id)
+        if (await db.execute(query)).scalar() is None:
+            raise HTTPException(status_code=404, detail="Response not found")
 
         return {"message": "Response deleted successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
-        await db.rollback()
         handle_server_error(e)
@@ -1,4 +1,5 @@
-from pydantic import BaseModel
+from typing import List
+from pydantic import BaseModel, Field
 
 class AddParamPayload(BaseModel):
     key: str
@@ -7,4 +8,11 @@ class AddParamPayload(BaseModel):
 
 class UpdateParamPayload(BaseModel):
     key: str = None
-    value: str = None
\ No newline at end of file
+    value: str = None
+
+class ParamItem(BaseModel):
+    key: str
+    value: str
+
+class ReplaceParamsPayload(BaseModel):
+    params: List[ParamItem] = Field(..., max_length=1000, description="Complete list of parameters; keys not listed are removed")
@@ -6,5 +6,11 @@ class RequestBody(BaseModel):
     url: str = Field(..., description="URL for the request")
     method: str = Field(..., description="HTTP method to use (GET, POST, etc.)")
     body: Optional[Dict] = Field(None, description="Request body for POST, PUT, or PATCH methods")
-    params: Optional[Dict] = Field(None, description="Query parameters for GET or DELETE methods")
-    bodytype: str = Field(..., description="Type of request body ('raw', 'form')")
\ No newline at end of file
+    params: Optional[Dict[str, str]] = Field(None, description="Query parameters for GET or DELETE methods")
+    bodytype: str = Field(..., description="Type of request body ('raw', 'form')")
+
+class LoadTestPayload(BaseModel):
+    total_requests: Optional[int] = Field(None, ge=1, description="Number of sends; mutually exclusive with duration_seconds")
+    duration_seconds: Optional[float] = Field(None, gt=0, le=3600, description="Run for a fixed time instead of a fixed count")
+    concurrency: int = Field(10, ge=1, le=100, description="Number of requests in flight at once")
+    rate: Optional[float] = Field(None, gt=0, description="Target requests per second; unset sends as fast as concurrency allows")
\ No newline at end of file
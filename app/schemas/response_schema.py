@@ -1,10 +1,15 @@
+from typing import Any
 from pydantic import BaseModel
 
 class SaveResponseRequest(BaseModel):
     request_id: int
-    body: dict  
+    body: Any
     status_code: int = None
+    # Stored alongside the body; string bodies default to text/plain and
+    # everything else to application/json.
+    content_type: str = None
 
 class UpdateResponseRequest(BaseModel):
-    body: dict = None  
-    status_code: int = None
\ No newline at end of file
+    body: Any = None
+    status_code: int = None
+    content_type: str = None
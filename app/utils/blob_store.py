@@ -0,0 +1,458 @@
+import asyncio
+import base64
+import hashlib
+import uuid
+import logging
+from dataclasses import dataclass, field
+from datetime import timedelta
+import ijson
+import orjson
+import zstandard
+from sqlalchemy import select, update, delete, func, text, any_, bindparam, null
+from sqlalchemy.dialects.postgresql import insert as pg_insert, ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import engine
+from app.models import response_bodies, response_body_chunks, response
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+BODY_CHUNK_SIZE = 256 * 1024
+ZSTD_LEVEL = 3
+JSON_CONTENT_TYPE = "application/json"
+TEXT_CONTENT_TYPE = "text/plain; charset=utf-8"
+# A body that lost its last response is kept this long, so a writer that is
+# about to reuse it never races the collector.
+BODY_GC_GRACE = timedelta(hours=1)
+BODY_GC_BATCH_SIZE = 1000
+# Chunks fetched per query when streaming a body back out.
+BODY_READ_WINDOW = 8
+# Moving pre-body-store JSONB bodies: small batches keep memory and lock
+# times low, and only one worker moves a batch at a time.
+LEGACY_BODY_BATCH_SIZE = 100
+LEGACY_BODY_PAUSE = 0.1
+LEGACY_BODY_RETRY_INTERVAL = 30
+LEGACY_BODY_LOCK_ID = 7_260_343_119
+
+# Decompression only happens on the event loop thread; compressors are
+# created per body because bodies are also compressed in worker threads and a
+# ZstdCompressor must not be shared between threads.
+_decompressor = zstandard.ZstdDecompressor()
+
+TEXT_MEDIA_TYPES = {
+    "application/xml", "application/javascript", "application/x-www-form-urlencoded",
+    "application/graphql", "application/yaml", "application/x-ndjson",
+}
+
+
+@dataclass
+class EncodedBody:
+    hash: str
+    size: int
+    chunks: list = field(default_factory=list)
+
+
+def _new_compressor():
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+
+
+def encode_body(data: bytes):
+    compressor = _new_compressor()
+    chunks = [compressor.compress(data[i:i + BODY_CHUNK_SIZE]) for i in range(0, len(data), BODY_CHUNK_SIZE)]
+    return EncodedBody(hash=hashlib.sha256(data).hexdigest(), size=len(data), chunks=chunks)
+
+
+def serialize_body(value, content_type: str = None):
+    # Bytes and content type for a body given as a parsed value (the JSON
+    # API and legacy JSONB rows). Strings are stored as-is, so HTML, XML or
+    # plain text keep their exact bytes.
+    if isinstance(value, str):
+        return value.encode(), content_type or TEXT_CONTENT_TYPE
+    return orjson.dumps(value), content_type or JSON_CONTENT_TYPE
+
+
+def _media_type(content_type: str):
+    return (content_type or "").split(";")[0].strip().lower()
+
+
+def is_json_content_type(content_type: str):
+    media_type = _media_type(content_type)
+    return media_type == JSON_CONTENT_TYPE or media_type.endswith("+json")
+
+
+def is_text_content_type(content_type: str):
+    # Bodies without a content type are treated as text, as they always were.
+    media_type = _media_type(content_type)
+    return (
+        not media_type
+        or media_type.startswith("text/")
+        or media_type in TEXT_MEDIA_TYPES
+        or media_type.endswith("+xml")
+        or is_json_content_type(content_type)
+    )
+
+
+def body_encoding(content_type: str):
+    return None if is_text_content_type(content_type) else "base64"
+
+
+def decode_body(data: bytes, content_type: str):
+    # JSON comes back parsed, text as a string, anything else base64-encoded.
+    if is_json_content_type(content_type):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    if is_text_content_type(content_type):
+        return data.decode("utf-8", errors="replace")
+    return base64.b64encode(data).decode()
+
+
+async def store_bodies(db: AsyncSession, bodies: list):
+    # One upsert for the body rows; chunks are only written for bodies that
+    # weren't stored yet. Touching last_used_at on conflict also row-locks an
+    # existing body, so the collector can't delete it under us. Rows are
+    # locked in hash order so concurrent writers can't deadlock each other.
+    unique = sorted({b.hash: b for b in bodies}.values(), key=lambda b: b.hash)
+    if not unique:
+        return
+    stmt = pg_insert(response_bodies).values([
+        {"hash": b.hash, "size": b.size, "chunk_size": BODY_CHUNK_SIZE} for b in unique
+    ])
+    stmt = stmt.on_conflict_do_update(index_elements=[response_bodies.c.hash], set_={"last_used_at": func.now()})
+    # xmax is 0 only for freshly inserted rows.
+    inserted = stmt.returning(response_bodies.c.hash, text("xmax = 0 AS inserted"))
+    new_hashes = {row.hash for row in await db.execute(inserted) if row.inserted}
+
+    chunk_rows = [
+        {"hash": b.hash, "seq": seq, "data": chunk}
+        for b in unique if b.hash in new_hashes
+        for seq, chunk in enumerate(b.chunks)
+    ]
+    if chunk_rows:
+        await db.execute(response_body_chunks.insert(), chunk_rows)
+
+
+class BodyWriter:
+    # Streams a body of any size into the store while it is being received.
+    # At most one uncompressed chunk is held in memory. A body that fits in a
+    # single chunk never touches the database until save_bodies(). Bigger
+    # ones are written chunk by chunk, in short transactions of their own,
+    # under a temporary key: the real key is the hash of the whole body,
+    # which is only known at the end.
+
+    def __init__(self):
+        self.hash = None
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._buffer = bytearray()
+        self._compressor = _new_compressor()
+        self._staging_key = None
+        self._seq = 0
+
+    @property
+    def spilled(self):
+        return self._staging_key is not None
+
+    async def write(self, data: bytes):
+        self._digest.update(data)
+        self.size += len(data)
+        self._buffer += data
+        while len(self._buffer) > BODY_CHUNK_SIZE:
+            chunk = bytes(self._buffer[:BODY_CHUNK_SIZE])
+            del self._buffer[:BODY_CHUNK_SIZE]
+            await self._write_chunk(chunk)
+
+    async def _write_chunk(self, chunk: bytes):
+        compressed = await asyncio.to_thread(self._compressor.compress, chunk)
+        async with engine.begin() as conn:
+            if self._staging_key is None:
+                self._staging_key = f"staging-{uuid.uuid4().hex}"
+                await conn.execute(response_bodies.insert().values(hash=self._staging_key, size=0, chunk_size=BODY_CHUNK_SIZE))
+            else:
+                # Keeps a long download from looking abandoned to the collector.
+                await conn.execute(
+                    update(response_bodies).where(response_bodies.c.hash == self._staging_key).values(last_used_at=func.now())
+                )
+            await conn.execute(response_body_chunks.insert().values(hash=self._staging_key, seq=self._seq, data=compressed))
+        self._seq += 1
+
+    async def close(self):
+        if self.spilled and self._buffer:
+            await self._write_chunk(bytes(self._buffer))
+            self._buffer = bytearray()
+        self.hash = self._digest.hexdigest()
+
+    def encoded(self):
+        chunks = [self._compressor.compress(bytes(self._buffer))] if self._buffer else []
+        return EncodedBody(hash=self.hash, size=self.size, chunks=chunks)
+
+    async def discard(self):
+        if self.spilled:
+            async with engine.begin() as conn:
+                await conn.execute(delete(response_bodies).where(response_bodies.c.hash == self._staging_key))
+            self._staging_key = None
+
+    async def publish(self, db: AsyncSession):
+        # Runs in the caller's transaction, so the body becomes visible under
+        # its hash together with the response row that points at it. If the
+        # same body is already stored, the staged copy is simply dropped.
+        stmt = pg_insert(response_bodies).values(hash=self.hash, size=self.size, chunk_size=BODY_CHUNK_SIZE)
+        stmt = stmt.on_conflict_do_update(index_elements=[response_bodies.c.hash], set_={"last_used_at": func.now()})
+        inserted = (await db.execute(stmt.returning(text("xmax = 0 AS inserted")))).scalar()
+        if inserted:
+            await db.execute(
+                update(response_body_chunks).where(response_body_chunks.c.hash == self._staging_key).values(hash=self.hash)
+            )
+        await db.execute(delete(response_bodies).where(response_bodies.c.hash == self._staging_key))
+
+
+async def save_bodies(db: AsyncSession, writers: list):
+    # Closed writers only. Small bodies share one upsert; staged ones are
+    # published one by one, also in hash order. Whether a body spills depends
+    # only on its size, so a hash is always locked in the same one of the two
+    # steps.
+    await store_bodies(db, [w.encoded() for w in writers if not w.spilled])
+    for writer in sorted((w for w in writers if w.spilled), key=lambda w: w.hash):
+        await writer.publish(db)
+
+
+async def load_bodies(db, hashes: list):
+    hash_array = bindparam("hashes", list(set(hashes)), type_=ARRAY(response_body_chunks.c.hash.type))
+    rows = await db.execute(
+        select(response_body_chunks.c.hash, response_body_chunks.c.data)
+        .where(response_body_chunks.c.hash == any_(hash_array))
+        .order_by(response_body_chunks.c.hash, response_body_chunks.c.seq)
+    )
+    parts = {h: [] for h in hashes}
+    for row in rows:
+        parts[row.hash].append(_decompressor.decompress(row.data))
+    return {h: b"".join(chunks) for h, chunks in parts.items()}
+
+
+async def load_body(db, hash: str):
+    return (await load_bodies(db, [hash]))[hash]
+
+
+async def response_body_value(db, row):
+    if row.body_hash is None:
+        return row.body
+    return decode_body(await load_body(db, row.body_hash), row.content_type)
+
+
+async def stream_body(hash: str, chunk_size: int, start: int, end: int):
+    # Yields bytes start..end (inclusive). Chunks have a fixed uncompressed
+    # size, so only the chunks overlapping the range are read and
+    # decompressed, a few at a time. Opens its own connection because it runs
+    # after the route has returned.
+    first, last = start // chunk_size, end // chunk_size
+    async with engine.connect() as conn:
+        for window in range(first, last + 1, BODY_READ_WINDOW):
+            rows = await conn.execute(
+                select(response_body_chunks.c.seq, response_body_chunks.c.data)
+                .where(
+                    response_body_chunks.c.hash == hash,
+                    response_body_chunks.c.seq.between(window, min(window + BODY_READ_WINDOW - 1, last)),
+                )
+                .order_by(response_body_chunks.c.seq)
+            )
+            for row in rows:
+                data = _decompressor.decompress(row.data)
+                offset = row.seq * chunk_size
+                yield data[max(start - offset, 0):end + 1 - offset]
+
+
+class JsonPointerMatcher:
+    # Follows ijson parse events, tracking the concrete path (keys and array
+    # indices, which ijson prefixes leave out) and builds only the value the
+    # pointer refers to.
+
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.value = None
+        self._path = []
+        self._frames = []
+        self._builder = None
+        self._depth = 0
+
+    def feed(self, event, value):
+        # Returns True once the value is complete.
+        if self._builder is not None:
+            self._builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                self._depth += 1
+            elif event in ("end_map", "end_array"):
+                self._depth -= 1
+                if self._depth == 0:
+                    self.value = self._builder.value
+                    return True
+            return False
+
+        if event == "map_key":
+            self._path[-1] = value
+            return False
+        if event in ("end_map", "end_array"):
+            self._frames.pop()
+            self._path.pop()
+            return False
+
+        if self._frames and self._frames[-1][0] == "array":
+            self._path[-1] = str(self._frames[-1][1])
+            self._frames[-1][1] += 1
+
+        if self._path == self.tokens:
+            if event in ("start_map", "start_array"):
+                self._builder = ijson.ObjectBuilder()
+                self._builder.event(event, value)
+                self._depth = 1
+                return False
+            self.value = value
+            return True
+
+        if event in ("start_map", "start_array"):
+            self._frames.append(["array" if event == "start_array" else "map", 0])
+            self._path.append(None)
+        return False
+
+
+async def extract_json_pointer(hash: str, tokens: list):
+    # Decompresses and parses chunk by chunk, stopping as soon as the value
+    # has been read. Raises KeyError if the pointer doesn't resolve and
+    # ijson.JSONError if the body isn't valid JSON.
+    matcher = JsonPointerMatcher(tokens)
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events, use_float=True)
+    async with engine.connect() as conn:
+        rows = await conn.stream(
+            select(response_body_chunks.c.data)
+            .where(response_body_chunks.c.hash == hash)
+            .order_by(response_body_chunks.c.seq)
+            .execution_options(yield_per=BODY_READ_WINDOW)
+        )
+        async for row in rows:
+            parser.send(_decompressor.decompress(row.data))
+            for _, event, value in events:
+                if matcher.feed(event, value):
+                    return matcher.value
+            events.clear()
+    parser.close()
+    for _, event, value in events:
+        if matcher.feed(event, value):
+            return matcher.value
+    raise KeyError("/".join(tokens))
+
+
+async def collect_orphaned_bodies():
+    # Responses reference bodies without cascading, so bodies whose last
+    # response was deleted (directly or through a request/collection) are
+    # removed here in batches. Chunks go with them via ON DELETE CASCADE.
+    total = 0
+    while True:
+        async with engine.begin() as conn:
+            result = await conn.execute(text(
+                "DELETE FROM response_bodies WHERE hash IN ("
+                "SELECT b.hash FROM response_bodies b "
+                "WHERE b.last_used_at < now() - CAST(:grace AS interval) "
+                "AND NOT EXISTS (SELECT 1 FROM response r WHERE r.body_hash = b.hash) "
+                "LIMIT :batch_size FOR UPDATE SKIP LOCKED) "
+                "AND last_used_at < now() - CAST(:grace AS interval)"
+            ), {"grace": BODY_GC_GRACE, "batch_size": BODY_GC_BATCH_SIZE})
+        total += result.rowcount
+        if result.rowcount < BODY_GC_BATCH_SIZE:
+            return total
+
+
+def _encode_legacy_bodies(rows):
+    encoded, updates = [], []
+    for row in rows:
+        data, content_type = serialize_body(row.body)
+        body = encode_body(data)
+        encoded.append(body)
+        updates.append({"row_id": row.id, "hash": body.hash, "size": body.size, "type": content_type})
+    return encoded, updates
+
+
+async def move_legacy_bodies():
+    # Rows written before the body store keep their JSONB body, which reads
+    # fall back to, so this runs in the background after startup rather than
+    # as a migration. Each batch stores its bodies and repoints its rows in
+    # one transaction; SKIP LOCKED keeps it off rows a live request holds.
+    select_batch = (
+        select(response.c.id, response.c.body)
+        .where(response.c.body.is_not(None), response.c.body_hash.is_(None))
+        .order_by(response.c.id)
+        .limit(LEGACY_BODY_BATCH_SIZE)
+        .with_for_update(skip_locked=True)
+    )
+    repoint = (
+        update(response)
+        .where(response.c.id == bindparam("row_id"))
+        .values(body_hash=bindparam("hash"), body_size=bindparam("size"), content_type=bindparam("type"), body=null())
+    )
+    total = 0
+    while True:
+        moved = 0
+        async with engine.begin() as conn:
+            locked = (await conn.execute(text("SELECT pg_try_advisory_xact_lock(:id)"), {"id": LEGACY_BODY_LOCK_ID})).scalar()
+            if locked:
+                rows = (await conn.execute(select_batch)).fetchall()
+                if not rows:
+                    return total
+                encoded, updates = await asyncio.to_thread(_encode_legacy_bodies, rows)
+                await store_bodies(conn, encoded)
+                await conn.execute(repoint, updates)
+                moved = len(rows)
+        total += moved
+        # Another worker holding the lock is moving bodies; check back later
+        # in case it goes away before finishing.
+        await asyncio.sleep(LEGACY_BODY_PAUSE if moved else LEGACY_BODY_RETRY_INTERVAL)
+
+
+class LegacyBodyMover:
+    def __init__(self):
+        self._task = None
+
+    async def _run(self):
+        try:
+            moved = await move_legacy_bodies()
+            if moved:
+                logger.info("Moved %s response bodies to the body store", moved)
+        except Exception as e:
+            logger.warning("Moving response bodies to the body store failed: %s", e)
+
+    async def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class BodyCollector:
+    def __init__(self, interval: int):
+        self.interval = interval
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                deleted = await collect_orphaned_bodies()
+                if deleted:
+                    logger.info("Deleted %s orphaned response bodies", deleted)
+            except Exception as e:
+                logger.warning("Response body collection failed: %s", e)
+
+    async def start(self):
+        if self.interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+body_collector = BodyCollector(settings.body_gc_interval_seconds)
+legacy_body_mover = LegacyBodyMover()
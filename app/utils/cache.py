@@ -0,0 +1,109 @@
+import time
+from collections import OrderedDict
+from app.settings import settings
+from app.utils.metrics import Counter, Gauge, register
+
+
+class LRUTTLCache:
+    # Single-threaded use only: every caller runs on the event loop, so no lock.
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Turned off while cross-worker invalidation is unavailable, since
+        # writes made by other workers can't be seen then.
+        self.enabled = True
+        self._entries = OrderedDict()
+        # Invalidations are numbered. A reader takes generation() before its
+        # SELECT and hands it to set(), which drops the row if the key was
+        # invalidated in between: the SELECT may have run before the commit
+        # that caused the eviction.
+        self._generation = 0
+        self._invalidated_at = {}
+        self._all_invalidated_at = 0
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def generation(self):
+        return self._generation
+
+    def set(self, key, value, generation=None):
+        if not self.enabled:
+            return
+        if generation is not None and max(self._all_invalidated_at, self._invalidated_at.get(key, 0)) > generation:
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+        self._generation += 1
+        self._invalidated_at[key] = self._generation
+        if len(self._invalidated_at) > self.maxsize:
+            # Keeps the bookkeeping bounded; every read in flight is treated
+            # as stale instead.
+            self._invalidated_at.clear()
+            self._all_invalidated_at = self._generation
+
+    def invalidate_where(self, predicate):
+        for key in [k for k, (value, _) in self._entries.items() if predicate(k, value)]:
+            del self._entries[key]
+        # The predicate can only be checked against cached rows, so a matching
+        # row that is being read right now can't be singled out.
+        self._generation += 1
+        self._all_invalidated_at = self._generation
+
+    def clear(self):
+        self._entries.clear()
+        self._generation += 1
+        self._all_invalidated_at = self._generation
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+        }
+
+
+# Rows keyed by (table name, id). Only tables that change rarely are cached.
+row_cache = LRUTTLCache(settings.cache_max_entries, settings.cache_ttl_seconds)
+CACHED_TABLES = {"collections", "requests"}
+
+register(Counter("row_cache_hits_total", "Row cache lookups served from memory.", collect=lambda: row_cache.hits))
+register(Counter("row_cache_misses_total", "Row cache lookups that went to the database.", collect=lambda: row_cache.misses))
+register(Gauge("row_cache_entries", "Rows currently held in the row cache.", collect=lambda: len(row_cache._entries)))
+
+INVALIDATION_CHANNEL = "row_cache_invalidation"
+
+
+def apply_invalidation(event: dict):
+    # event is {"table": ..., "id": ...} for one row, or
+    # {"table": "requests", "collection_id": ...} for every request of a collection.
+    table = event["table"]
+    if "id" in event:
+        row_cache.invalidate((table, event["id"]))
+    elif "collection_id" in event:
+        collection_id = event["collection_id"]
+        row_cache.invalidate_where(lambda key, row: key[0] == table and row.collection_id == collection_id)
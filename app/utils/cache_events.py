@@ -0,0 +1,114 @@
+import asyncio
+import json
+import logging
+import asyncpg
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from app.database import engine, run_after_commit
+from app.utils.cache import row_cache, apply_invalidation, INVALIDATION_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+# Postgres rejects NOTIFY payloads of 8000 bytes or more.
+MAX_PAYLOAD_BYTES = 7000
+RECONNECT_DELAYS = (0.5, 1, 2, 5, 10)
+
+
+def queue_invalidation(db, invalidation: dict):
+    # Evict locally right away and again after commit; other workers hear
+    # about it through NOTIFY, which Postgres only delivers once the
+    # transaction commits.
+    apply_invalidation(invalidation)
+    run_after_commit(db, lambda: apply_invalidation(invalidation))
+    db.info.setdefault("cache_invalidations", []).append(invalidation)
+
+
+def _payloads(invalidations):
+    batch = []
+    for invalidation in invalidations:
+        candidate = batch + [invalidation]
+        if batch and len(json.dumps(candidate)) > MAX_PAYLOAD_BYTES:
+            yield json.dumps(batch)
+            candidate = [invalidation]
+        batch = candidate
+    if batch:
+        yield json.dumps(batch)
+
+
+@event.listens_for(Session, "before_commit")
+def _publish_invalidations(session):
+    invalidations = session.info.pop("cache_invalidations", None)
+    if not invalidations:
+        return
+    # Runs inside the write transaction, so the whole write still costs one
+    # extra statement however many keys it touched.
+    for payload in _payloads(invalidations):
+        session.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": INVALIDATION_CHANNEL, "payload": payload})
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _drop_invalidations(session, previous_transaction):
+    session.info.pop("cache_invalidations", None)
+
+
+class InvalidationListener:
+    def __init__(self):
+        self._connection = None
+        self._task = None
+        self._closing = False
+
+    def _dsn(self):
+        return engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+
+    def _on_notification(self, connection, pid, channel, payload):
+        try:
+            for invalidation in json.loads(payload):
+                apply_invalidation(invalidation)
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignoring malformed cache invalidation: %r", payload)
+
+    def _on_connection_lost(self, connection):
+        if self._closing:
+            return
+        # Notifications sent while we're disconnected are lost, so nothing
+        # cached can be trusted until we are listening again.
+        row_cache.enabled = False
+        row_cache.clear()
+        logger.warning("Cache invalidation listener disconnected; caching disabled until it reconnects")
+        self._task = asyncio.get_running_loop().create_task(self._connect())
+
+    async def _connect(self):
+        attempt = 0
+        while not self._closing:
+            try:
+                connection = await asyncpg.connect(self._dsn())
+                await connection.add_listener(INVALIDATION_CHANNEL, self._on_notification)
+                connection.add_termination_listener(self._on_connection_lost)
+            except (OSError, asyncpg.PostgresError) as e:
+                delay = RECONNECT_DELAYS[min(attempt, len(RECONNECT_DELAYS) - 1)]
+                logger.warning("Cache invalidation listener could not connect (%s); retrying in %ss", e, delay)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+
+            self._connection = connection
+            row_cache.clear()
+            row_cache.enabled = True
+            logger.info("Listening for cache invalidations on channel %s", INVALIDATION_CHANNEL)
+            return
+
+    async def start(self):
+        self._closing = False
+        row_cache.enabled = False
+        self._task = asyncio.get_running_loop().create_task(self._connect())
+
+    async def stop(self):
+        self._closing = True
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+
+
+invalidation_listener = InvalidationListener()
@@ -0,0 +1,255 @@
+import asyncio
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any
+import httpx
+from sqlalchemy.exc import SQLAlchemyError
+from app.database import SessionLocal
+from app.models import BodyType, response
+from app.utils.http_client import get_http_client
+from app.utils.blob_store import BodyWriter, save_bodies, decode_body
+
+DEFAULT_RUN_CONCURRENCY = 10
+MAX_RUN_CONCURRENCY = 100
+RUN_SAVE_BATCH_SIZE = 100
+MAX_REPORTED_ERRORS = 50
+# With keep_body, bodies up to this size are also decoded and returned to the
+# caller; bigger ones are only streamed into storage.
+INLINE_BODY_LIMIT = 1024 * 1024
+# Finished results waiting to be saved during a run. Workers wait once this
+# many are queued, so a slow save doesn't let results pile up in memory.
+RUN_RESULT_QUEUE_SIZE = 2 * RUN_SAVE_BATCH_SIZE
+# Received chunks waiting to be stored. When storage falls this far behind,
+# the download waits for it rather than buffering the whole body.
+BODY_QUEUE_CHUNKS = 4
+
+
+class BodyStorageError(Exception):
+    pass
+
+
+# httpcore trace events that open and close each stored phase. DNS resolution
+# happens inside httpcore's connect_tcp step, so it is part of connect_ms.
+PHASE_EVENTS = {
+    "connect_ms": ("connection.connect_tcp.started", "connection.connect_tcp.complete"),
+    "tls_ms": ("connection.start_tls.started", "connection.start_tls.complete"),
+    "ttfb_ms": ("send_request_body.complete", "receive_response_headers.complete"),
+    "download_ms": ("receive_response_body.started", "receive_response_body.complete"),
+}
+
+
+class PhaseTracer:
+    def __init__(self):
+        self.marks = {}
+
+    async def __call__(self, event_name, info):
+        # Strip the "http11." / "http2." prefix so both protocols share keys.
+        if not event_name.startswith("connection."):
+            event_name = event_name.split(".", 1)[1]
+        self.marks[event_name] = time.perf_counter()
+
+    def timings(self):
+        result = {}
+        for phase, (start_event, end_event) in PHASE_EVENTS.items():
+            start, end = self.marks.get(start_event), self.marks.get(end_event)
+            # Phases that didn't happen (e.g. a reused keep-alive connection
+            # skips connect and TLS) are stored as NULL rather than 0.
+            result[phase] = round((end - start) * 1000, 3) if start is not None and end is not None else None
+        return result
+
+
+@dataclass
+class ExecutionResult:
+    status_code: int
+    body: Any
+    elapsed_ms: float
+    timings: dict
+    content_type: str = None
+    body_writer: BodyWriter = None
+
+    def as_row(self, request_id: int):
+        return {
+            "request_id": request_id,
+            "body_hash": self.body_writer.hash,
+            "body_size": self.body_writer.size,
+            "content_type": self.content_type,
+            "status_code": self.status_code,
+            "total_ms": self.elapsed_ms,
+            **self.timings,
+        }
+
+
+class BodySink:
+    # Feeds a BodyWriter from its own task, so compressing and writing
+    # spilled chunks happens beside the download instead of inside the loop
+    # that the download timings measure.
+
+    def __init__(self, writer: BodyWriter):
+        self.writer = writer
+        self.error = None
+        self._chunks = asyncio.Queue(maxsize=BODY_QUEUE_CHUNKS)
+        self._task = asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        while (chunk := await self._chunks.get()) is not None:
+            if self.error is not None:
+                # Keep taking chunks so the download never blocks on a full
+                # queue; it stops at its next chunk.
+                continue
+            try:
+                await self.writer.write(chunk)
+            except Exception as e:
+                self.error = e
+
+    async def put(self, chunk: bytes):
+        await self._chunks.put(chunk)
+
+    async def close(self):
+        await self._chunks.put(None)
+        await self._task
+        if self.error is None:
+            try:
+                await self.writer.close()
+            except Exception as e:
+                self.error = e
+        if self.error is not None:
+            raise BodyStorageError(f"Storing the response body failed: {self.error}") from self.error
+
+    async def abort(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await self.writer.discard()
+
+
+def build_request_kwargs(request_row, param_rows):
+    kwargs = {}
+    if param_rows:
+        kwargs["params"] = [(p.key, p.value) for p in param_rows]
+    if request_row.body is not None:
+        if request_row.bodytype == BodyType.form:
+            kwargs["data"] = request_row.body
+        elif isinstance(request_row.body, str):
+            # Imported raw text that isn't JSON.
+            kwargs["content"] = request_row.body.encode()
+        else:
+            kwargs["json"] = request_row.body
+    return kwargs
+
+
+async def execute_request(request_row, param_rows, keep_body: bool = False):
+    client = get_http_client()
+    tracer = PhaseTracer()
+    writer = BodyWriter()
+    sink = BodySink(writer)
+    inline = bytearray() if keep_body else None
+    start = time.perf_counter()
+    try:
+        async with client.stream(
+            request_row.method,
+            request_row.url,
+            extensions={"trace": tracer},
+            **build_request_kwargs(request_row, param_rows)
+        ) as resp:
+            async for chunk in resp.aiter_bytes():
+                if sink.error is not None:
+                    break
+                await sink.put(chunk)
+                if inline is not None:
+                    inline += chunk
+                    if len(inline) > INLINE_BODY_LIMIT:
+                        inline = None
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        await sink.close()
+    except BaseException:
+        await sink.abort()
+        raise
+
+    content_type = resp.headers.get("content-type")
+    return ExecutionResult(
+        status_code=resp.status_code,
+        body=decode_body(bytes(inline), content_type) if inline is not None else None,
+        elapsed_ms=round(elapsed_ms, 3),
+        timings=tracer.timings(),
+        content_type=content_type,
+        body_writer=writer,
+    )
+
+
+@dataclass
+class RunSummary:
+    total: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    saved: int = 0
+    errors: list = field(default_factory=list)
+
+
+def group_params(param_rows):
+    params_by_request = defaultdict(list)
+    for p in param_rows:
+        params_by_request[p.request_id].append(p)
+    return params_by_request
+
+
+def _record_failure(summary: RunSummary, request_id: int, error: str):
+    summary.failed += 1
+    if len(summary.errors) < MAX_REPORTED_ERRORS:
+        summary.errors.append({"request_id": request_id, "error": error})
+
+
+async def _save_results(queue: asyncio.Queue, summary: RunSummary):
+    # Single writer: drains whatever has finished so far into one multi-row
+    # insert, so results land in the table while the run is still going.
+    finished = False
+    while not finished:
+        batch = []
+        item = await queue.get()
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= RUN_SAVE_BATCH_SIZE or queue.empty():
+                break
+            item = queue.get_nowait()
+        finished = item is None
+
+        if batch:
+            try:
+                async with SessionLocal() as session:
+                    await save_bodies(session, [result.body_writer for _, result in batch])
+                    await session.execute(response.insert(), [result.as_row(request_id) for request_id, result in batch])
+                    await session.commit()
+            except SQLAlchemyError as e:
+                # Staged bodies of the lost batch are left to the collector.
+                summary.succeeded -= len(batch)
+                for request_id, _ in batch:
+                    _record_failure(summary, request_id, f"Saving the response failed: {e}")
+                continue
+            summary.saved += len(batch)
+
+
+async def run_requests(request_rows, params_by_request, concurrency: int = DEFAULT_RUN_CONCURRENCY):
+    summary = RunSummary(total=len(request_rows))
+    pending = iter(request_rows)
+    queue = asyncio.Queue(maxsize=RUN_RESULT_QUEUE_SIZE)
+
+    async def worker():
+        for request_row in pending:
+            try:
+                result = await execute_request(request_row, params_by_request.get(request_row.id, []))
+            except (httpx.HTTPError, httpx.InvalidURL, BodyStorageError) as e:
+                _record_failure(summary, request_row.id, str(e))
+                continue
+            summary.succeeded += 1
+            await queue.put((request_row.id, result))
+
+    async with asyncio.TaskGroup() as tg:
+        writer = tg.create_task(_save_results(queue, summary))
+        workers = [tg.create_task(worker()) for _ in range(min(concurrency, len(request_rows)))]
+        await asyncio.gather(*workers)
+        await queue.put(None)
+        await writer
+
+    return summary
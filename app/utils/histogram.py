@@ -0,0 +1,84 @@
+import math
+
+
+class LatencyHistogram:
+    # Log-linear bucketing in the style of HdrHistogram: fixed memory, a bounded
+    # relative error set by significant_figures, and two histograms with the
+    # same settings can be merged by adding their counts.
+
+    def __init__(self, lowest: int = 1, highest: int = 3_600_000_000, significant_figures: int = 3):
+        if lowest < 1 or highest < 2 * lowest or not 1 <= significant_figures <= 5:
+            raise ValueError("Invalid histogram range or precision")
+
+        self.lowest = lowest
+        self.highest = highest
+        self.significant_figures = significant_figures
+
+        largest_single_unit = 2 * 10 ** significant_figures
+        sub_bucket_count_magnitude = max(math.ceil(math.log2(largest_single_unit)), 1)
+        self._unit_magnitude = int(math.floor(math.log2(lowest)))
+        self._sub_bucket_half_count_magnitude = sub_bucket_count_magnitude - 1
+        self._sub_bucket_count = 1 << sub_bucket_count_magnitude
+        self._sub_bucket_half_count = self._sub_bucket_count // 2
+        self._sub_bucket_mask = (self._sub_bucket_count - 1) << self._unit_magnitude
+
+        smallest_untrackable = self._sub_bucket_count << self._unit_magnitude
+        bucket_count = 1
+        while smallest_untrackable <= highest:
+            smallest_untrackable <<= 1
+            bucket_count += 1
+
+        self._counts = [0] * ((bucket_count + 1) * self._sub_bucket_half_count)
+        self.total_count = 0
+        self.min_value = None
+        self.max_value = None
+        self._sum = 0
+
+    def _index_for(self, value: int) -> int:
+        bucket_index = (value | self._sub_bucket_mask).bit_length() - self._unit_magnitude - (self._sub_bucket_half_count_magnitude + 1)
+        sub_bucket_index = value >> (bucket_index + self._unit_magnitude)
+        return ((bucket_index + 1) << self._sub_bucket_half_count_magnitude) + (sub_bucket_index - self._sub_bucket_half_count)
+
+    def _highest_equivalent_value(self, index: int) -> int:
+        bucket_index = (index >> self._sub_bucket_half_count_magnitude) - 1
+        sub_bucket_index = (index & (self._sub_bucket_half_count - 1)) + self._sub_bucket_half_count
+        if bucket_index < 0:
+            sub_bucket_index -= self._sub_bucket_half_count
+            bucket_index = 0
+        shift = bucket_index + self._unit_magnitude
+        return (sub_bucket_index << shift) + (1 << shift) - 1
+
+    def record(self, value: int, count: int = 1):
+        value = min(max(int(value), 0), self.highest)
+        self._counts[self._index_for(value)] += count
+        self.total_count += count
+        self._sum += value * count
+        self.min_value = value if self.min_value is None else min(self.min_value, value)
+        self.max_value = value if self.max_value is None else max(self.max_value, value)
+
+    def merge(self, other: "LatencyHistogram"):
+        if (other.lowest, other.highest, other.significant_figures) != (self.lowest, self.highest, self.significant_figures):
+            raise ValueError("Cannot merge histograms with different settings")
+        for i, count in enumerate(other._counts):
+            if count:
+                self._counts[i] += count
+        self.total_count += other.total_count
+        self._sum += other._sum
+        for value in (other.min_value, other.max_value):
+            if value is not None:
+                self.min_value = value if self.min_value is None else min(self.min_value, value)
+                self.max_value = value if self.max_value is None else max(self.max_value, value)
+
+    def value_at_percentile(self, percentile: float) -> int:
+        if not self.total_count:
+            return 0
+        target = max(math.ceil(percentile / 100 * self.total_count), 1)
+        running = 0
+        for i, count in enumerate(self._counts):
+            running += count
+            if running >= target:
+                return min(self._highest_equivalent_value(i), self.max_value)
+        return self.max_value
+
+    def mean(self) -> float:
+        return self._sum / self.total_count if self.total_count else 0.0
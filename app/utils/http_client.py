@@ -0,0 +1,28 @@
+import httpx
+
+# One client per process so connections to the same host are kept alive and
+# reused across sends instead of paying TCP/TLS setup on every request.
+HTTP_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=30.0)
+
+_client: httpx.AsyncClient = None
+
+
+def start_http_client():
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS, follow_redirects=True)
+    return _client
+
+
+def get_http_client() -> httpx.AsyncClient:
+    if _client is None:
+        raise RuntimeError("HTTP client has not been started")
+    return _client
+
+
+async def close_http_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,84 @@
+import asyncio
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Optional
+import httpx
+from app.utils.executor import build_request_kwargs
+from app.utils.histogram import LatencyHistogram
+from app.utils.http_client import get_http_client
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+@dataclass
+class WorkerStats:
+    histogram: LatencyHistogram = field(default_factory=LatencyHistogram)
+    status_codes: Counter = field(default_factory=Counter)
+    errors: Counter = field(default_factory=Counter)
+
+
+async def run_load_test(request_row, param_rows, concurrency: int, total_requests: Optional[int] = None,
+                        duration_seconds: Optional[float] = None, rate: Optional[float] = None):
+    client = get_http_client()
+    kwargs = build_request_kwargs(request_row, param_rows)
+    start = time.perf_counter()
+    deadline = start + duration_seconds if duration_seconds else None
+    issued = 0
+
+    def next_send_time():
+        # With a target rate every send has a fixed slot on the schedule and
+        # latency is measured from that slot, so a slow server can't hide
+        # its queueing delay by holding back the senders.
+        nonlocal issued
+        if total_requests is not None and issued >= total_requests:
+            return None
+        scheduled = start + issued / rate if rate else time.perf_counter()
+        if deadline is not None and scheduled >= deadline:
+            return None
+        issued += 1
+        return scheduled
+
+    async def worker(stats: WorkerStats):
+        while (scheduled := next_send_time()) is not None:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                resp = await client.request(request_row.method, request_row.url, **kwargs)
+                stats.status_codes[resp.status_code] += 1
+            except (httpx.HTTPError, httpx.InvalidURL) as e:
+                stats.errors[type(e).__name__] += 1
+            stats.histogram.record((time.perf_counter() - scheduled) * 1_000_000)
+
+    worker_stats = [WorkerStats() for _ in range(concurrency)]
+    await asyncio.gather(*(worker(stats) for stats in worker_stats))
+    elapsed = time.perf_counter() - start
+
+    merged = WorkerStats()
+    for stats in worker_stats:
+        merged.histogram.merge(stats.histogram)
+        merged.status_codes.update(stats.status_codes)
+        merged.errors.update(stats.errors)
+
+    return summarize(merged, elapsed)
+
+
+def summarize(stats: WorkerStats, elapsed: float):
+    histogram = stats.histogram
+    to_ms = lambda us: round(us / 1000, 3)
+
+    latency = {"min": to_ms(histogram.min_value or 0), "mean": to_ms(histogram.mean())}
+    for p in PERCENTILES:
+        latency[f"p{p:g}"] = to_ms(histogram.value_at_percentile(p))
+    latency["max"] = to_ms(histogram.max_value or 0)
+
+    return {
+        "requests": histogram.total_count,
+        "errors": sum(stats.errors.values()),
+        "error_types": dict(stats.errors),
+        "status_codes": {str(code): count for code, count in sorted(stats.status_codes.items())},
+        "duration_seconds": round(elapsed, 3),
+        "throughput_rps": round(histogram.total_count / elapsed, 3) if elapsed else 0.0,
+        "latency_ms": latency,
+    }
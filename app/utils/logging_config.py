@@ -0,0 +1,139 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+import secrets
+import sys
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import orjson
+from app.settings import settings
+from app.utils.metrics import Counter, register
+
+# Records are handed to a background thread through a bounded queue: the event
+# loop only pays for an append, and formatting plus the write to stderr happen
+# on the listener thread. If the queue fills up (stderr stalled), records are
+# dropped and counted rather than blocking request handling.
+
+current_request_id: ContextVar[str | None] = ContextVar("current_request_id", default=None)
+log_sampled: ContextVar[bool] = ContextVar("log_sampled", default=True)
+
+log_records_dropped = register(Counter("log_records_dropped_total", "Log records dropped because the log queue was full"))
+
+_RESERVED_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName", "request_id"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+
+class RequestContextFilter(logging.Filter):
+    # Runs in the logging thread, so this is where the request context is read;
+    # the listener thread has no access to it.
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING and not log_sampled.get():
+            return False
+        record.request_id = current_request_id.get()
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The stock implementation formats the message here, on the caller's
+        # thread. Leave msg/args alone so formatting is done by the listener.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+
+_listener = None
+
+
+def setup_logging():
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.Queue(maxsize=settings.log_queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(settings.log_level)
+    # uvicorn installs its own stream handlers before importing the app; send
+    # its records through the queue as well.
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+class RequestLogContextMiddleware:
+    # Tags every record logged while handling a request with its request id and
+    # decides once per request whether its INFO/DEBUG records are kept, so a
+    # sampled request logs completely rather than a random subset of lines.
+
+    def __init__(self, app, sample_rate: float = 1.0):
+        self.app = app
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        if not request_id:
+            request_id = secrets.token_hex(8)
+
+        id_token = current_request_id.set(request_id)
+        sampled_token = log_sampled.set(self.sample_rate >= 1.0 or random.random() < self.sample_rate)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            log_sampled.reset(sampled_token)
+            current_request_id.reset(id_token)
@@ -0,0 +1,248 @@
+import bisect
+import logging
+import os
+import time
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# Collectors are plain per-process dicts: every update happens on the event
+# loop thread (SQLAlchemy's cursor events run there too, inside greenlets), so
+# there is nothing to lock. Each uvicorn worker serves its own numbers, tagged
+# with a worker label so scraped series never collide.
+WORKER = str(os.getpid())
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values):
+    pairs = [("worker", WORKER)] + list(zip(names, values))
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        # Optional callable for counters kept elsewhere (e.g. the row cache).
+        self._collect = collect
+
+    def inc(self, *labelvalues, amount=1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        values = {(): self._collect()} if self._collect else self._values
+        for labelvalues, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, documentation, collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self._collect = collect
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def render(self):
+        value = self._collect() if self._collect else self.value
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name}{_format_labels((), ())} {value}"]
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labelvalues -> [per-bucket counts (last one is +Inf), sum, count]
+        self._series = {}
+
+    def observe(self, value, *labelvalues):
+        series = self._series.get(labelvalues)
+        if series is None:
+            series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labelvalues, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _format_labels(self.labelnames + ("le",), labelvalues + (le,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+http_requests_total = Counter("http_requests_total", "HTTP requests handled, by route template and status.", ("method", "route", "status"))
+http_request_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route template.", ("method", "route"))
+http_requests_in_flight = Gauge("http_requests_in_flight", "HTTP requests currently being handled.")
+db_statements_total = Counter("db_statements_total", "SQL statements executed, by leading keyword.", ("operation",))
+db_statement_duration = Histogram("db_statement_duration_seconds", "SQL statement latency, by leading keyword.", ("operation",))
+db_pool_checkout_wait = Histogram("db_pool_checkout_wait_seconds", "Time spent waiting for a pooled database connection.")
+
+REGISTRY = [
+    http_requests_total,
+    http_request_duration,
+    http_requests_in_flight,
+    db_statements_total,
+    db_statement_duration,
+    db_pool_checkout_wait,
+]
+
+
+def register(collector):
+    REGISTRY.append(collector)
+    return collector
+
+
+def render_metrics():
+    lines = []
+    for collector in REGISTRY:
+        lines.extend(collector.render())
+    return "\n".join(lines) + "\n"
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_checkout_wait.observe(time.perf_counter() - start)
+
+
+class RequestDBStats:
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# Set per HTTP request by ServerTimingMiddleware. SQLAlchemy runs cursor
+# events in a greenlet that shares the request task's context, so the events
+# see the same object.
+current_db_stats: ContextVar = ContextVar("current_db_stats", default=None)
+
+
+def _statement_operation(statement):
+    words = statement.lstrip().split(None, 1)
+    return words[0].upper() if words else "UNKNOWN"
+
+
+def instrument_engine(sync_engine):
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("statement_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["statement_start"].pop()
+        operation = _statement_operation(statement)
+        db_statements_total.inc(operation)
+        db_statement_duration.observe(elapsed, operation)
+
+        stats = current_db_stats.get()
+        if stats is not None:
+            stats.count += 1
+            stats.seconds += elapsed
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _discard_timer(context):
+        starts = context.connection.info.get("statement_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+
+class MetricsMiddleware:
+    # Pure ASGI rather than BaseHTTPMiddleware, to keep per-request overhead
+    # down and leave streaming responses alone.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        start = time.perf_counter()
+        http_requests_in_flight.inc()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.dec()
+            # The router fills in scope["route"]; label by its template so
+            # /collections/1 and /collections/2 share one series.
+            route = scope.get("route")
+            template = getattr(route, "path", "<unmatched>")
+            http_requests_total.inc(scope["method"], template, str(status))
+            http_request_duration.observe(time.perf_counter() - start, scope["method"], template)
+
+
+class ServerTimingMiddleware:
+    # Reports the SQL issued while handling each request in a Server-Timing
+    # header and warns when a route goes over its statement budget, which is
+    # how N+1 query regressions show up.
+
+    def __init__(self, app, query_budget: int):
+        self.app = app
+        self.query_budget = query_budget
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestDBStats()
+        token = current_db_stats.set(stats)
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                # For streamed responses this covers the statements issued
+                # before the first byte.
+                total_ms = (time.perf_counter() - start) * 1000
+                header = f'db;dur={stats.seconds * 1000:.3f}, db-count;desc="{stats.count}", total;dur={total_ms:.3f}'
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", header.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_db_stats.reset(token)
+            if self.query_budget and stats.count > self.query_budget:
+                route = getattr(scope.get("route"), "path", scope["path"])
+                logger.warning(
+                    "%s %s issued %s SQL statements (budget %s, %.1f ms in the database)",
+                    scope["method"], route, stats.count, self.query_budget, stats.seconds * 1000,
+                )
@@ -0,0 +1,267 @@
+import json
+from collections import defaultdict
+from urllib.parse import urlsplit, urlunsplit, urlencode
+import ijson
+import orjson
+from sqlalchemy import insert, select, func, text, any_, bindparam, Integer
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import engine
+from app.models import requests, params, response, BodyType
+from app.utils.blob_store import load_body, decode_body
+
+POSTMAN_SCHEMA_V21 = "https://schema.getpostman.com/json/collection/v2.1.0/collection.json"
+SUPPORTED_METHODS = ("GET", "POST", "PUT", "PATCH", "DELETE")
+BODY_METHODS = ("POST", "PUT", "PATCH")
+IMPORT_BATCH_SIZE = 500
+# asyncpg caps a statement at 32767 bind parameters; a params row takes three.
+PARAMS_INSERT_CHUNK = 5000
+EXPORT_CHUNK_SIZE = 500
+# Output is handed to the client once this much has been built up, so a chunk
+# full of large response bodies is never held all at once.
+EXPORT_FLUSH_BYTES = 1024 * 1024
+
+
+def is_v21_schema(schema):
+    # Postman has published the same schema under more than one host.
+    return isinstance(schema, str) and "/json/collection/v2.1." in schema
+
+
+def _is_item_prefix(prefix: str):
+    # Items sit at "item.item", folder children at "item.item.item.item", ...
+    parts = prefix.split(".")
+    return len(parts) % 2 == 0 and all(part == "item" for part in parts)
+
+
+class PostmanRequestParser:
+    # Consumes ijson parse events and collects the "request" object of every
+    # item, at any folder depth. Only one request is materialised at a time,
+    # and saved example responses are skipped without being built.
+
+    def __init__(self):
+        self.collection_name = None
+        self.schema = None
+        self.requests = []
+        self._builder = None
+        self._depth = 0
+
+    def feed(self, prefix, event, value):
+        if self._builder is not None:
+            self._builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                self._depth += 1
+            elif event in ("end_map", "end_array"):
+                self._depth -= 1
+                if self._depth == 0:
+                    self.requests.append(self._builder.value)
+                    self._builder = None
+            return
+
+        if prefix == "info.name" and event == "string":
+            self.collection_name = value
+        elif prefix == "info.schema" and event == "string":
+            self.schema = value
+        elif prefix.endswith(".request") and _is_item_prefix(prefix[: -len(".request")]):
+            if event == "string":
+                # Shorthand form: the request is just a URL.
+                self.requests.append({"method": "GET", "url": value})
+            elif event in ("start_map", "start_array"):
+                self._builder = ijson.ObjectBuilder()
+                self._builder.event(event, value)
+                self._depth = 1
+
+    def drain(self):
+        pending, self.requests = self.requests, []
+        return pending
+
+
+def _enabled(entries):
+    return [e for e in entries or [] if isinstance(e, dict) and not e.get("disabled") and e.get("key") is not None]
+
+
+def _convert_body(body):
+    if not isinstance(body, dict):
+        return None, None
+    mode = body.get("mode")
+    if mode == "raw":
+        # Anything that isn't a JSON document is kept as the original text and
+        # sent as-is rather than as a JSON string.
+        raw = body.get("raw") or ""
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            return raw, BodyType.raw
+        return (raw if isinstance(value, str) else value), BodyType.raw
+    if mode in ("urlencoded", "formdata"):
+        fields = {e["key"]: str(e.get("value") or "") for e in _enabled(body.get(mode)) if e.get("type", "text") == "text"}
+        return fields, BodyType.form
+    return None, None
+
+
+def convert_request(request: dict):
+    # Returns (requests row values, params dict), or None for methods this
+    # API can't send.
+    method = str(request.get("method") or "GET").upper()
+    if method not in SUPPORTED_METHODS:
+        return None
+
+    url = request.get("url")
+    query = {}
+    if isinstance(url, dict):
+        query = {e["key"]: str(e.get("value") or "") for e in _enabled(url.get("query"))}
+        url = url.get("raw") or ""
+        if query:
+            # Query parameters are stored as params; keeping them in the URL
+            # too would send them twice.
+            url = urlunsplit(urlsplit(url)._replace(query=""))
+
+    body, bodytype = _convert_body(request.get("body"))
+    if method not in BODY_METHODS:
+        body = None
+
+    return {"url": url or "", "method": method, "body": body, "bodytype": bodytype}, query
+
+
+async def insert_imported_requests(db: AsyncSession, collection_id: int, batch: list):
+    # Ids are allocated up front so params can reference their request without
+    # relying on the order of a multi-row RETURNING.
+    ids = (await db.execute(
+        select(func.nextval(text("pg_get_serial_sequence('requests', 'id')"))).select_from(func.generate_series(1, len(batch)))
+    )).scalars().all()
+
+    request_rows, param_rows = [], []
+    for request_id, (values, query) in zip(ids, batch):
+        request_rows.append({"id": request_id, "collection_id": collection_id, **values})
+        param_rows.extend({"request_id": request_id, "key": key, "value": value} for key, value in query.items())
+
+    await db.execute(insert(requests).values(request_rows))
+    for start in range(0, len(param_rows), PARAMS_INSERT_CHUNK):
+        await db.execute(insert(params).values(param_rows[start:start + PARAMS_INSERT_CHUNK]))
+    return len(param_rows)
+
+
+def _export_body(request_row):
+    if request_row.body is None:
+        return None
+    if request_row.bodytype == BodyType.form and isinstance(request_row.body, dict):
+        return {"mode": "urlencoded", "urlencoded": [{"key": k, "value": str(v)} for k, v in request_row.body.items()]}
+    if isinstance(request_row.body, str):
+        return {"mode": "raw", "raw": request_row.body, "options": {"raw": {"language": "text"}}}
+    return {"mode": "raw", "raw": orjson.dumps(request_row.body).decode(), "options": {"raw": {"language": "json"}}}
+
+
+def export_item(request_row, param_rows, latest_response=None):
+    query = [{"key": p.key, "value": p.value} for p in param_rows]
+    raw_url = request_row.url or ""
+    if query:
+        raw_url += ("&" if "?" in raw_url else "?") + urlencode([(p.key, p.value) for p in param_rows])
+
+    item = {
+        "name": f"{request_row.method} {request_row.url}",
+        "request": {"method": request_row.method, "url": {"raw": raw_url, "query": query}},
+        "response": [],
+    }
+    body = _export_body(request_row)
+    if body is not None:
+        item["request"]["body"] = body
+    if latest_response is not None:
+        body = latest_response["body"]
+        item["response"].append({
+            "name": f"Response {latest_response['id']}",
+            "code": latest_response["status_code"],
+            "body": body if isinstance(body, str) else orjson.dumps(body).decode(),
+        })
+    return item
+
+
+def export_record(request_row, param_rows, latest_response=None):
+    record = {
+        "type": "request",
+        "id": request_row.id,
+        "url": request_row.url,
+        "method": request_row.method,
+        "body": request_row.body,
+        "bodytype": request_row.bodytype.value if request_row.bodytype else None,
+        "params": [{"key": p.key, "value": p.value} for p in param_rows],
+    }
+    if latest_response is not None:
+        record["latest_response"] = latest_response
+    return record
+
+
+async def _fetch_chunk_details(conn, ids, include_responses: bool):
+    # Bound as one array so every chunk reuses the same prepared statement.
+    id_array = bindparam("ids", ids, type_=ARRAY(Integer))
+    params_by_request = defaultdict(list)
+    for p in await conn.execute(select(params).where(params.c.request_id == any_(id_array)).order_by(params.c.id)):
+        params_by_request[p.request_id].append(p)
+
+    latest = {}
+    if include_responses:
+        # Bodies are left out here and loaded one at a time as items are
+        # written, legacy JSONB ones included.
+        columns = [c for c in response.c if c.name != "body"]
+        rows = await conn.execute(
+            select(*columns)
+            .where(response.c.request_id == any_(id_array))
+            .distinct(response.c.request_id)
+            .order_by(response.c.request_id, response.c.id.desc())
+        )
+        latest = {r.request_id: r for r in rows}
+    return params_by_request, latest
+
+
+async def _response_body(conn, row):
+    if row.body_hash is None:
+        return (await conn.execute(select(response.c.body).where(response.c.id == row.id))).scalar()
+    return decode_body(await load_body(conn, row.body_hash), row.content_type)
+
+
+async def _latest_response(conn, row):
+    if row is None:
+        return None
+    return {
+        "id": row.id,
+        "status_code": row.status_code,
+        "content_type": row.content_type,
+        "body": await _response_body(conn, row),
+        "total_ms": row.total_ms,
+    }
+
+
+async def stream_collection_export(collection, export_format: str, include_responses: bool):
+    # Runs after the route returned, so it can't use the request's session. A
+    # repeatable-read transaction keeps requests, params and responses
+    # consistent with each other, and the server-side cursor keeps one chunk
+    # of requests in memory at a time.
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="REPEATABLE READ")
+        if export_format == "ndjson":
+            yield orjson.dumps({"type": "collection", "id": collection.id, "name": collection.name}) + b"\n"
+        else:
+            info = {"_postman_id": str(collection.id), "name": collection.name, "schema": POSTMAN_SCHEMA_V21}
+            yield b'{"info":' + orjson.dumps(info) + b',"item":['
+
+        query = select(requests).where(requests.c.collection_id == collection.id).order_by(requests.c.id)
+        result = await conn.stream(query.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+        first = True
+        async for chunk in result.partitions():
+            params_by_request, latest = await _fetch_chunk_details(conn, [r.id for r in chunk], include_responses)
+            out = bytearray()
+            for r in chunk:
+                latest_response = await _latest_response(conn, latest.get(r.id))
+                if export_format == "ndjson":
+                    out += orjson.dumps(export_record(r, params_by_request[r.id], latest_response)) + b"\n"
+                else:
+                    if not first:
+                        out += b","
+                    out += orjson.dumps(export_item(r, params_by_request[r.id], latest_response))
+                first = False
+                if len(out) >= EXPORT_FLUSH_BYTES:
+                    yield bytes(out)
+                    out = bytearray()
+            if out:
+                yield bytes(out)
+
+        if export_format != "ndjson":
+            yield b"]}"
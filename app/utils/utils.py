@@ -1,23 +1,115 @@
-from fastapi import HTTPException
+from fastapi import HTTPException, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from app.models import requests, params, collections
+from sqlalchemy import update, delete, or_, func, case, cast, literal_column, Text
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert as pg_insert
+from app.models import requests, params, collections, listing_versions
+from app.utils.cache import row_cache, CACHED_TABLES
+from app.utils.cache_events import queue_invalidation
+from app.utils.logging_config import setup_logging
 import logging
 
 # Set up the logger
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
-async def get_or_404(db: AsyncSession, model, id, message="Resource not found"):
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+async def fetch_row(db: AsyncSession, model, id):
+    cacheable = model.name in CACHED_TABLES
+    if cacheable:
+        row = row_cache.get((model.name, id))
+        if row is not None:
+            return row
+        generation = row_cache.generation()
+
     result = await db.execute(select(model).where(model.c.id == id))
-    result = result.fetchone()
+    row = result.fetchone()
+    if row is not None and cacheable:
+        row_cache.set((model.name, id), row, generation)
+    return row
+
+def invalidate_cached_row(db: AsyncSession, model, id):
+    queue_invalidation(db, {"table": model.name, "id": id})
+
+def invalidate_collection_requests(db: AsyncSession, collection_id: int):
+    queue_invalidation(db, {"table": requests.name, "collection_id": collection_id})
+
+async def bump_collection_version(db: AsyncSession, collection_id: int):
+    result = await db.execute(
+        update(collections)
+        .where(collections.c.id == collection_id)
+        .values(version=collections.c.version + 1)
+        .returning(collections.c.id)
+    )
+    if result.scalar() is None:
+        raise HTTPException(status_code=404, detail="Collection not found")
+    invalidate_cached_row(db, collections, collection_id)
+
+async def bump_listing_version(db: AsyncSession, name: str):
+    # Transactional, unlike a sequence: readers can't see the new version
+    # before the rows it describes are committed.
+    await db.execute(
+        update(listing_versions)
+        .where(listing_versions.c.name == name)
+        .values(version=listing_versions.c.version + 1)
+    )
+
+async def get_listing_version(db: AsyncSession, name: str):
+    result = await db.execute(select(listing_versions.c.version).where(listing_versions.c.name == name))
+    return result.scalar() or 0
+
+def make_etag(*parts):
+    return '"' + "-".join(str(p) for p in parts) + '"'
+
+def etag_matches(if_none_match: str, etag: str):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so a W/ prefix doesn't matter.
+    candidates = (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+    return etag in candidates
+
+def not_modified(etag: str):
+    return Response(status_code=304, headers={"ETag": etag})
+
+def parse_byte_range(range_header: str, size: int):
+    # Single "bytes=" ranges only. Returns (start, end) inclusive, or None to
+    # serve the whole body, which is also what RFC 9110 allows for multi-range
+    # or malformed headers.
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_text, _, end_text = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start_text == "":
+            suffix = int(end_text)
+            start, end = (max(size - suffix, 0) if suffix > 0 else size), size - 1
+        else:
+            start = int(start_text)
+            end = min(int(end_text), size - 1) if end_text else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+def parse_json_pointer(pointer: str):
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise HTTPException(status_code=400, detail="JSON Pointer must be empty or start with '/'")
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")]
+
+async def get_or_404(db: AsyncSession, model, id, message="Resource not found"):
+    result = await fetch_row(db, model, id)
     if not result:
         raise HTTPException(status_code=404, detail=message)
     return result
 
 async def check_collection_exists(db: AsyncSession, collection_id: int):
-    result = await db.execute(select(collections).where(collections.c.id == collection_id))
-    collection = result.fetchone()
+    collection = await fetch_row(db, collections, collection_id)
     if not collection:
         raise HTTPException(status_code=404, detail="Collection not found")
     return collection
@@ -30,8 +122,7 @@ async def check_requests_exist(db: AsyncSession, collection_id: int):
     return requests_list
 
 async def check_request_exists(db: AsyncSession, request_id: int):
-    result = await db.execute(select(requests).where(requests.c.id == request_id))
-    request_exists = result.fetchone()
+    request_exists = await fetch_row(db, requests, request_id)
     if not request_exists:
         raise HTTPException(status_code=404, detail="Request not found")
     return request_exists
@@ -43,6 +134,66 @@ async def check_param_exists(db: AsyncSession, param_id: int):
         raise HTTPException(status_code=404, detail="Parameter not found")
     return param_exists
 
+def upsert_params(request_id: int, values: dict):
+    # One multi-row statement for the whole set. Rows whose value didn't
+    # change are left alone instead of being rewritten.
+    stmt = pg_insert(params).values([
+        {"request_id": request_id, "key": key, "value": value} for key, value in values.items()
+    ])
+    return stmt.on_conflict_do_update(
+        index_elements=[params.c.request_id, params.c.key],
+        set_={"value": stmt.excluded.value},
+        where=params.c.value.is_distinct_from(stmt.excluded.value),
+    )
+
+async def replace_params(db: AsyncSession, request_id: int, values: dict):
+    await db.execute(
+        delete(params).where(
+            params.c.request_id == request_id,
+            or_(params.c.key.is_(None), params.c.key.not_in(list(values))),
+        )
+    )
+    if values:
+        await db.execute(upsert_params(request_id, values))
+
+def keyset_page(query, id_column, limit: int, after: int = None):
+    # Seek past the last id of the previous page instead of using OFFSET, so
+    # every page costs the same no matter how deep it is. One extra row is
+    # fetched to tell whether another page exists.
+    if after is not None:
+        query = query.where(id_column > after)
+    return query.order_by(id_column).limit(limit + 1)
+
+def json_page_query(query, id_column, limit: int, after: int = None, key: str = "items", envelope: dict = None):
+    # A keyset_page whose JSON document is rendered by Postgres; the route
+    # sends the text as-is with no per-row Python work.
+    rn = func.row_number().over(order_by=id_column).label("rn")
+    page = keyset_page(query.add_columns(rn), id_column, limit, after).subquery()
+    in_page = page.c.rn <= limit
+
+    fields = []
+    for column in page.c:
+        if column.name != "rn":
+            fields += [literal_column(f"'{column.name}'"), column]
+    items = func.coalesce(
+        func.json_agg(aggregate_order_by(func.json_build_object(*fields), page.c[id_column.name])).filter(in_page),
+        literal_column("'[]'::json"),
+    )
+    next_cursor = case((func.count() > limit, func.max(page.c[id_column.name]).filter(in_page)))
+
+    members = []
+    for name, value in (envelope or {}).items():
+        members += [literal_column(f"'{name}'"), value]
+    members += [literal_column(f"'{key}'"), items, literal_column("'next_cursor'"), next_cursor]
+
+    return select(
+        func.count().filter(in_page).label("count"),
+        cast(func.json_build_object(*members), Text).label("body"),
+    ).select_from(page)
+
+def raw_json_response(body: str, etag: str = None):
+    return Response(content=body.encode(), media_type="application/json", headers={"ETag": etag} if etag else None)
+
 def handle_server_error(e):
     raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 